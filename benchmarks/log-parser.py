@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the targeted log parser against the pymatgen GaussianOutput path.
+
+Each log is parsed both ways and the results compared. TD-DFT logs are compared
+on their excitation energies and NMR logs on their magnetic shielding tensors,
+where the installed pymatgen provides read_magnetic_shielding.
+
+usage: log-parser.py [--repeat 3] td.log nics_singlet.log ...
+"""
+
+import os
+import sys
+import time
+import argparse
+
+from pymatgen.io.gaussian import GaussianOutput
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+import gaussian_parser  # noqa: E402
+
+
+def best_time(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        timings.append(time.time() - start)
+    return min(timings), result
+
+
+def pymatgen_path(filename):
+    gout = GaussianOutput(filename)
+    result = {'terminated': gout.properly_terminated,
+              'excitations': gout.read_excitation_energies()}
+    if hasattr(gout, 'read_magnetic_shielding'):
+        result['shielding'] = gout.read_magnetic_shielding()
+    return result
+
+
+def fast_path(filename):
+    with open(filename, 'rb') as f:
+        content = f.read()
+    return {'terminated': gaussian_parser.properly_terminated(content),
+            'excitations': gaussian_parser.read_excitation_energies(content),
+            'shielding': gaussian_parser.read_magnetic_shielding(content)}
+
+
+def compare(slow, fast):
+    if slow['terminated'] != fast['terminated']:
+        return False
+    # older pymatgen versions don't return the symmetry of the transitions
+    width = min([len(e) for e in slow['excitations']] + [4])
+    if ([tuple(e[:width]) for e in slow['excitations']] !=
+            [e[:width] for e in fast['excitations']]):
+        return False
+    if 'shielding' in slow:
+        return ([s['isotropic'] for s in slow['shielding']] ==
+                [s['isotropic'] for s in fast['shielding']])
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('logs', nargs='+')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print('{:>30} {:>10} {:>14} {:>12} {:>8} {:>6}'.format(
+        'log', 'size (MB)', 'pymatgen (s)', 'fast (s)', 'speedup', 'same'))
+    for filename in args.logs:
+        slow_time, slow = best_time(lambda: pymatgen_path(filename),
+                                    args.repeat)
+        fast_time, fast = best_time(lambda: fast_path(filename), args.repeat)
+        print('{:>30} {:>10.1f} {:>14.3f} {:>12.4f} {:>8.0f} {:>6}'.format(
+            os.path.basename(filename)[-30:],
+            os.path.getsize(filename) / 1e6, slow_time, fast_time,
+            slow_time / fast_time, 'yes' if compare(slow, fast) else 'NO'))
+
+
+if __name__ == '__main__':
+    main()
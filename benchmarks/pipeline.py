@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the workflow end to end, with the stub g09 standing in for Gaussian.
+
+The scripts are run as they would be on the cluster, from a copy of src/ in a
+temporary workspace, and timed at each of the requested scales:
+
+    generate: generate-structures.py over the full library (structures/s),
+        run once as the library is a fixed size
+    lookup: fetching random records from the structure store by index and by
+        title
+    calculate: calculate-properties.py --worker on --compounds compounds with
+        the stub g09 (see stub/g09), giving the time per compound spent
+        outside g09, i.e. the orchestration overhead
+    extract: extract-data.py over --archives synthetic archives, reading the
+        per-compound tarballs and then the single log archive made by
+        pack-archives.py (archives/s), checking that every compound is in
+        both the json and the --columnar results
+
+At each scale the structure store holds that many compounds, made from the
+generated library and repeated with new titles past its size, and the queue
+and ledger are filled with all of them, so the per-compound costs that grow
+with the campaign show up. The store takes ~8 kB per compound, so the 1M
+scale needs ~8 GB of disk (see --tmp-dir).
+
+The results are printed and written as json (--output), along with the commit
+and machine they were measured on, so runs can be compared to catch
+regressions.
+
+usage: pipeline.py [--scales 1000 10000] [--stages generate lookup calculate
+                   extract] [--compounds 20] [--archives 1000] [-n 1]
+                   [--library structures.db] [--output pipeline.json]
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import tarfile
+import argparse
+import platform
+import tempfile
+import subprocess
+
+repo = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(repo, 'src'))
+from store import StructureStore  # noqa: E402
+from ledger import Ledger  # noqa: E402
+from work_queue import WorkQueue  # noqa: E402
+from archives import find_archive, open_archive  # noqa: E402
+from results import Results  # noqa: E402
+
+stages = ('generate', 'lookup', 'calculate', 'extract')
+
+
+def make_workspace(tmp_dir):
+    """
+    Lay out a copy of the repository to run the scripts in, as they find the
+    data and templates relative to src/.
+    """
+    shutil.copytree(os.path.join(repo, 'src'), os.path.join(tmp_dir, 'src'),
+                    ignore=shutil.ignore_patterns('__pycache__', '*.ipynb'))
+    os.symlink(os.path.abspath(os.path.join(repo, 'templates')),
+               os.path.join(tmp_dir, 'templates'))
+    os.makedirs(os.path.join(tmp_dir, 'data'))
+
+
+def run_script(workspace, script, args=(), cwd='src', env=None):
+    """
+    Run one of the scripts in the workspace.
+
+    Returns:
+        (float): The wall time in seconds.
+    """
+    environ = dict(os.environ)
+    environ['PATH'] = os.path.abspath(os.path.join(repo, 'benchmarks',
+                                                   'stub')) + \
+        os.pathsep + environ.get('PATH', '')
+    environ.update(env or {})
+    start = time.time()
+    process = subprocess.run(
+        [sys.executable, os.path.join(workspace, 'src', script)] + list(args),
+        cwd=os.path.join(workspace, cwd), env=environ, stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT)
+    seconds = time.time() - start
+    if process.returncode:
+        sys.stderr.write(process.stdout.decode('utf-8', 'replace'))
+        raise RuntimeError('{} failed'.format(script))
+    return seconds
+
+
+def bench_generate(workspace, processes):
+    db_file = os.path.join(workspace, 'data', 'library.db')
+    seconds = run_script(workspace, 'generate-structures.py',
+                         ['--db', db_file, '-n', str(processes)])
+    with StructureStore(db_file, readonly=True) as db:
+        n = len(db)
+    return {'structures': n, 'seconds': seconds,
+            'structures_per_s': n / seconds}
+
+
+def replicate(record, copy, size):
+    """
+    Make the copy-th repeat of a library record, with a new index and title.
+    """
+    record = dict(record)
+    title = record['title'].replace('_nx-', '{}_nx-'.format(copy), 1)
+    record['input'] = dict(record['input'], title=title)
+    record['title'] = title
+    record['index'] += copy * size
+    if record.get('alias_of'):
+        record['alias_of'] += copy * size
+    if record.get('fingerprint'):
+        record['fingerprint'] = '{}:{}'.format(record['fingerprint'], copy)
+    return record
+
+
+def make_store(library, filename, n):
+    """
+    Write a structure store of n compounds from the library.
+    """
+    with StructureStore(library, readonly=True) as db:
+        records = list(db.all())
+    with StructureStore(filename) as db:
+        for start in range(0, n, 10000):
+            chunk = []
+            for i in range(start, min(start + 10000, n)):
+                copy, r = divmod(i, len(records))
+                chunk.append(replicate(records[r], copy, len(records))
+                             if copy else records[r])
+            db.insert_multiple(chunk)
+
+
+def time_lookups(lookup, keys):
+    timings = []
+    for key in keys:
+        start = time.time()
+        record = lookup(key)
+        timings.append(time.time() - start)
+        assert record is not None
+    timings.sort()
+    return {'mean_us': 1e6 * sum(timings) / len(timings),
+            'median_us': 1e6 * timings[len(timings) // 2],
+            'p99_us': 1e6 * timings[int(len(timings) * 0.99)]}
+
+
+def bench_lookup(db_file, lookups):
+    with StructureStore(db_file, readonly=True) as db:
+        indices = random.sample(sorted(db.indices()), min(lookups, len(db)))
+        titles = [db.get(index)['title'] for index in indices]
+    # open the store fresh, as each task would
+    with StructureStore(db_file, readonly=True) as db:
+        by_index = time_lookups(db.get, indices)
+        by_title = time_lookups(db.get_by_title, titles)
+    return dict([('index_' + k, v) for k, v in by_index.items()] +
+                [('title_' + k, v) for k, v in by_title.items()])
+
+
+def representatives(db_file, n):
+    """
+    Get the first n compounds that are calculated, rather than aliases.
+    """
+    indices = []
+    with StructureStore(db_file, readonly=True) as db:
+        for record in db.all():
+            if not record.get('alias_of'):
+                indices.append(record['index'])
+                if len(indices) == n:
+                    break
+    return indices
+
+
+def bench_calculate(workspace, compounds):
+    data = os.path.join(workspace, 'data')
+    for name in ('queue.db', 'ledger.db'):
+        if os.path.exists(os.path.join(data, name)):
+            os.remove(os.path.join(data, name))
+    shutil.rmtree(os.path.join(data, 'calculations'), ignore_errors=True)
+
+    db_file = os.path.join(data, 'structures.db')
+    chosen = representatives(db_file, compounds)
+    with StructureStore(db_file, readonly=True) as db:
+        indices = db.indices()
+    # queue everything, as the workers would, but leave only the chosen
+    # compounds to be calculated
+    with WorkQueue(os.path.join(data, 'queue.db')) as queue:
+        queue.add(indices)
+        queue.conn.execute("UPDATE queue SET state = 'done'")
+        queue.conn.executemany("UPDATE queue SET state = 'pending' "
+                               "WHERE idx = ?", ((i,) for i in chosen))
+
+    seconds = run_script(workspace, 'calculate-properties.py',
+                         ['--worker', '--queue', 'queue.db'], cwd='data',
+                         env={'STUB_G09_SLEEP': '0'})
+
+    with Ledger(os.path.join(data, 'ledger.db')) as ledger:
+        runs = list(ledger.runs())
+        overheads = ledger.overhead_totals()
+        archived = ledger.status()['counts']['archived']
+    g09_seconds = sum(run['wall_time'] for run in runs)
+    n = max(len(chosen), 1)
+    result = {'compounds': len(chosen), 'archived': archived,
+              'g09_runs': len(runs), 'seconds': seconds,
+              'g09_seconds': g09_seconds,
+              'overhead_per_compound': (seconds - g09_seconds) / n}
+    for name, (_, total) in overheads.items():
+        result['{}_per_compound'.format(name)] = total / n
+    return result
+
+
+def read_members(tar_file):
+    members = {}
+    with open_archive(tar_file) as tar:
+        for member in tar:
+            if member.isfile():
+                members[os.path.basename(member.name)] = \
+                    tar.extractfile(member).read()
+    return members
+
+
+def write_archives(workspace, titles, members):
+    """
+    Write a <title>.tar.gz archive of the members for each of the titles.
+    """
+    calculations = os.path.join(workspace, 'data', 'calculations')
+    for title in titles:
+        with tarfile.open(os.path.join(calculations, title + '.tar.gz'),
+                          'w:gz', compresslevel=6) as tar:
+            for name, content in sorted(members.items()):
+                info = tarfile.TarInfo('{}/{}'.format(title, name))
+                info.size = len(content)
+                info.mtime = time.time()
+                tar.addfile(info, io.BytesIO(content))
+
+
+def bench_extract(workspace, archives, workers):
+    data = os.path.join(workspace, 'data')
+    db_file = os.path.join(data, 'structures.db')
+    chosen = representatives(db_file, archives)
+    with StructureStore(db_file, readonly=True) as db:
+        titles = [db.get(index)['title'] for index in chosen]
+    # the logs of a compound calculated by bench_calculate
+    members = read_members(find_archive(os.path.join(data, 'calculations'),
+                                        titles[0]))
+
+    shutil.rmtree(os.path.join(data, 'calculations'))
+    os.makedirs(os.path.join(data, 'calculations'))
+    for name in ('calculations.pack', 'calculations.pack.idx'):
+        if os.path.exists(os.path.join(data, name)):
+            os.remove(os.path.join(data, name))
+    write_archives(workspace, titles, members)
+
+    # the tarballs are read before they're packed, then the log archive is
+    # read in their place, also writing the columnar results
+    tar_seconds = run_script(workspace, 'extract-data.py',
+                             ['-n', str(workers)])
+    pack_seconds = run_script(workspace, 'pack-archives.py')
+    archive_seconds = run_script(workspace, 'extract-data.py',
+                                 ['-n', str(workers), '--columnar'])
+    with open(os.path.join(data, 'calculated-data.json')) as f:
+        rows = len(json.load(f).get('_default', {}))
+    columnar = len(Results(os.path.join(data, 'calculated-data-columnar')))
+    if rows != len(titles) or columnar != rows:
+        raise RuntimeError('extracted {} archives, but calculated-data.json '
+                           'has {} rows and the columnar results {}'.format(
+                               len(titles), rows, columnar))
+    return {'archives': len(titles), 'rows': rows,
+            'tar_seconds': tar_seconds,
+            'tar_archives_per_s': len(titles) / tar_seconds,
+            'pack_seconds': pack_seconds,
+            'log_archive_seconds': archive_seconds,
+            'log_archive_archives_per_s': len(titles) / archive_seconds}
+
+
+def metadata():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=repo,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'host': socket.gethostname(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def report(result):
+    print('{:>10} {:>9} {}'.format(
+        result['stage'], result['scale'] or '-', ' '.join(
+            '{}={:.4g}'.format(k, v) if isinstance(v, float) else
+            '{}={}'.format(k, v) for k, v in sorted(result.items())
+            if k not in ('stage', 'scale'))))
+    sys.stdout.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--scales', type=int, nargs='+', default=[1000, 10000],
+                        help='numbers of compounds in the campaign')
+    parser.add_argument('--stages', nargs='+', choices=stages,
+                        default=list(stages))
+    parser.add_argument('--compounds', type=int, default=20,
+                        help='compounds calculated at each scale')
+    parser.add_argument('--archives', type=int, default=1000,
+                        help='archives extracted at each scale, at most the '
+                             'scale')
+    parser.add_argument('--lookups', type=int, default=1000)
+    parser.add_argument('-n', '--processes', type=int, default=1,
+                        help='processes for generate and extract')
+    parser.add_argument('--library',
+                        help='structure store to scale up from, instead of '
+                             'the one made by the generate stage')
+    parser.add_argument('--tmp-dir', help='where to make the workspace')
+    parser.add_argument('--output', help='write the results as json here')
+    args = parser.parse_args()
+    if 'generate' not in args.stages and not args.library:
+        parser.error('--library is needed without the generate stage')
+
+    results = []
+
+    def record(stage, scale, result):
+        result = dict(result, stage=stage, scale=scale)
+        report(result)
+        results.append(result)
+
+    workspace = tempfile.mkdtemp(dir=args.tmp_dir)
+    try:
+        make_workspace(workspace)
+        library = args.library and os.path.abspath(args.library)
+        if 'generate' in args.stages:
+            record('generate', None, bench_generate(workspace,
+                                                    args.processes))
+            library = library or os.path.join(workspace, 'data', 'library.db')
+
+        for scale in args.scales:
+            db_file = os.path.join(workspace, 'data', 'structures.db')
+            if os.path.exists(db_file):
+                os.remove(db_file)
+            make_store(library, db_file, scale)
+            if 'lookup' in args.stages:
+                record('lookup', scale, bench_lookup(db_file, args.lookups))
+            if 'calculate' in args.stages:
+                record('calculate', scale,
+                       bench_calculate(workspace, args.compounds))
+            if 'extract' in args.stages:
+                if 'calculate' not in args.stages:
+                    # for the logs to put in the archives
+                    bench_calculate(workspace, 1)
+                record('extract', scale,
+                       bench_extract(workspace, min(args.archives, scale),
+                                     args.processes))
+    finally:
+        shutil.rmtree(workspace)
+
+    output = {'meta': metadata(), 'args': vars(args), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the latency of looking up single records in the structure store.
+
+Synthetic stores are built in a temporary directory for each of the requested
+sizes and random records are then fetched by index and by title. The records
+carry a padding payload of the same size as a GaussianInput.as_dict() for the
+ciba scaffold (~8 kB), so the 1M record store needs ~8 GB of disk; use
+--payload-size to shrink it.
+
+usage: store-lookup.py [--sizes 10000 1000000] [--lookups 1000] [--tinydb]
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import itertools
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+from store import StructureStore  # noqa: E402
+
+
+def make_records(n, payload_size):
+    payload = 'x' * payload_size
+    for index in range(1, n + 1):
+        yield {'input': {'payload': payload}, 'nx': None, 'ny': None,
+               'x_sub': None, 'y_sub': None, 'z_sub': None,
+               'title': 'bench_{}'.format(index), 'index': index}
+
+
+def time_lookups(lookup, keys):
+    timings = []
+    for key in keys:
+        start = time.time()
+        record = lookup(key)
+        timings.append(time.time() - start)
+        assert record is not None
+    timings.sort()
+    return {'mean': sum(timings) / len(timings),
+            'median': timings[len(timings) // 2],
+            'p99': timings[int(len(timings) * 0.99)]}
+
+
+def report(name, size, stats):
+    print('{:>8} {:>10} {:>12.1f} {:>12.1f} {:>12.1f}'.format(
+        name, size, stats['mean'] * 1e6, stats['median'] * 1e6,
+        stats['p99'] * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 1000000])
+    parser.add_argument('--lookups', type=int, default=1000)
+    parser.add_argument('--payload-size', type=int, default=8000)
+    parser.add_argument('--tinydb', action='store_true',
+                        help='also time the old TinyDB lookup (slow)')
+    args = parser.parse_args()
+
+    print('{:>8} {:>10} {:>12} {:>12} {:>12}'.format(
+        'lookup', 'records', 'mean (us)', 'median (us)', 'p99 (us)'))
+    for size in args.sizes:
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp_dir, 'structures.db')
+            records = make_records(size, args.payload_size)
+            with StructureStore(filename) as store:
+                while True:
+                    chunk = list(itertools.islice(records, 10000))
+                    if not chunk:
+                        break
+                    store.insert_multiple(chunk)
+
+            indices = [random.randint(1, size) for _ in range(args.lookups)]
+            titles = ['bench_{}'.format(i) for i in indices]
+            # open the store fresh, as each array task would
+            with StructureStore(filename, readonly=True) as store:
+                report('index', size, time_lookups(store.get, indices))
+                report('title', size, time_lookups(store.get_by_title, titles))
+
+            if args.tinydb:
+                from tinydb import TinyDB, Query
+                json_file = os.path.join(tmp_dir, 'structures.json')
+                TinyDB(json_file).insert_multiple(
+                    make_records(size, args.payload_size))
+                query = Query()
+
+                def tinydb_lookup(index):
+                    # reopen the db on each lookup, as each array task does
+                    return TinyDB(json_file).get(query.index == index)
+                report('tinydb', size,
+                       time_lookups(tinydb_lookup, indices[:10]))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
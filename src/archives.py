@@ -0,0 +1,236 @@
+"""
+Writing and reading the archives of the calculations.
+
+Each compound's calculation directory is archived as <title>.tar.gz, or as
+<title>.tar.zst with the zstandard package installed, and <title>_error.tar.gz
+(or .tar.zst) if it didn't finish. The checkpoints aren't archived. Archives
+are written under a temporary name and renamed once complete, so one that is
+still being written is never taken for a finished compound.
+
+The Archiver writes archives on a background thread, so a worker can get on
+with the next compound while the last one is compressed and copied back to the
+shared filesystem.
+"""
+
+import os
+import time
+import queue
+import shutil
+import tarfile
+import threading
+import traceback
+
+from contextlib import contextmanager
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+suffixes = {'gz': '.tar.gz', 'zst': '.tar.zst'}
+default_levels = {'gz': 6, 'zst': 3}
+
+
+def check_compression(compression):
+    """
+    Check that a compression can be used, raising a ValueError if not.
+    """
+    if compression not in suffixes:
+        raise ValueError('unknown compression: {}'.format(compression))
+    if compression == 'zst' and zstandard is None:
+        raise ValueError('zst compression needs the zstandard package')
+
+
+def archive_name(title, compression='gz', error=False):
+    return '{}{}{}'.format(title, '_error' if error else '',
+                           suffixes[compression])
+
+
+def find_archive(directory, title, error=False):
+    """
+    Find the archive of a compound in a directory, whatever its compression.
+
+    Returns:
+        (str): The path to the archive, or None if there isn't one.
+    """
+    for compression in sorted(suffixes):
+        filename = os.path.join(directory,
+                                archive_name(title, compression, error))
+        if os.path.isfile(filename):
+            return filename
+    return None
+
+
+def archive_title(filename):
+    """
+    Get the title of the compound, i.e. the folder in the archive, from the
+    name of an archive.
+    """
+    name = os.path.basename(filename)
+    for suffix in suffixes.values():
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    if name.endswith('_error'):
+        name = name[:-len('_error')]
+    return name
+
+
+@contextmanager
+def open_archive(filename, mode='r', level=None):
+    """
+    Open an archive as a stream of tar members, for reading ('r') or writing
+    ('w'), with the compression given by its name.
+    """
+    if filename.endswith(suffixes['zst']):
+        check_compression('zst')
+        with open(filename, mode + 'b') as f:
+            if mode == 'r':
+                stream = zstandard.ZstdDecompressor().stream_reader(f)
+            else:
+                stream = zstandard.ZstdCompressor(
+                    level=level or default_levels['zst']).stream_writer(f)
+            # the compressed stream has to be closed before the file
+            with stream, tarfile.open(fileobj=stream, mode=mode + '|') as tar:
+                yield tar
+    elif mode == 'r':
+        with tarfile.open(filename, 'r|gz') as tar:
+            yield tar
+    else:
+        with tarfile.open(filename, 'w:gz',
+                          compresslevel=level or default_levels['gz']) as tar:
+            yield tar
+
+
+def _exclude_checkpoints(member):
+    return None if member.name.endswith('.chk') else member
+
+
+def write_archive(filename, directory, level=None):
+    """
+    Archive a calculation directory, leaving out the checkpoints.
+    """
+    part = filename + '.part'
+    try:
+        with open_archive(part, 'w', level) as tar:
+            tar.add(directory, arcname=os.path.basename(directory),
+                    filter=_exclude_checkpoints)
+    except BaseException:
+        if os.path.isfile(part):
+            os.remove(part)
+        raise
+    os.replace(part, filename)
+
+
+def is_within_directory(directory, target):
+    """
+    Check that a path, e.g. where an archive member would be unpacked to,
+    doesn't lead out of a directory, comparing whole path components so that
+    ../data-evil isn't taken to be within ../data.
+    """
+    abs_directory = os.path.abspath(directory)
+    abs_target = os.path.abspath(target)
+    return os.path.commonpath([abs_directory, abs_target]) == abs_directory
+
+
+def extract_archive(filename, path='.'):
+    """
+    Unpack an archive into path, which then holds the <title> directory.
+    """
+    with open_archive(filename) as tar:
+        for member in tar:
+            if not is_within_directory(path, os.path.join(path, member.name)):
+                raise Exception("Attempted Path Traversal in Tar File")
+            tar.extract(member, path)
+
+
+class Archiver(threading.Thread):
+    """
+    Archive calculation directories on a background thread, removing each
+    directory once its archive has been written. A directory that can't be
+    archived is copied back next to its archive if it was elsewhere, e.g. in
+    scratch.
+
+    Args:
+        level (int): The compression level, or None for the default of the
+            compression.
+    """
+
+    def __init__(self, level=None):
+        super(Archiver, self).__init__()
+        self.daemon = True
+        self.level = level
+        self.jobs = queue.Queue()
+        self.done = queue.Queue()
+        # the keys of the directories queued but not yet given back
+        self.pending = set()
+
+    def add(self, directory, filename, key):
+        """
+        Queue a directory to be archived as filename. The key is given back
+        by finished once it has been.
+        """
+        self.pending.add(key)
+        self.jobs.put((directory, filename, key))
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            directory, filename, key = job
+            start = time.time()
+            try:
+                write_archive(filename, directory, self.level)
+                shutil.rmtree(directory)
+                error = None
+            except Exception:
+                error = traceback.format_exc()
+                if not os.path.isfile(filename):
+                    error += self._copy_back(directory, filename)
+            self.done.put((key, time.time() - start, error))
+
+    @staticmethod
+    def _copy_back(directory, filename):
+        """
+        Copy a directory that couldn't be archived from scratch to next to its
+        archive, so the calculations can be carried on from by whichever
+        worker takes the compound next.
+
+        Returns:
+            (str): The traceback if it couldn't be copied, otherwise ''.
+        """
+        target = os.path.join(os.path.dirname(filename),
+                              os.path.basename(directory))
+        if not os.path.isdir(directory) or \
+                os.path.abspath(directory) == os.path.abspath(target):
+            return ''
+        try:
+            shutil.copytree(directory, target, dirs_exist_ok=True)
+            shutil.rmtree(directory)
+        except Exception:
+            return traceback.format_exc()
+        return ''
+
+    def finished(self):
+        """
+        Get the directories archived since the last call.
+
+        Returns:
+            (list): (key, seconds, error) for each, where error is the
+            traceback if the archive couldn't be written, otherwise None.
+        """
+        done = []
+        while True:
+            try:
+                key, seconds, error = self.done.get_nowait()
+            except queue.Empty:
+                return done
+            self.pending.discard(key)
+            done.append((key, seconds, error))
+
+    def close(self):
+        """
+        Wait for the queued directories to be archived.
+        """
+        self.jobs.put(None)
+        self.join()
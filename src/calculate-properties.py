@@ -1,12 +1,16 @@
 #!/usr/bin/env python
 
 import os
-import sys
-import tarfile
+import re
 import shutil
-
-import numpy as np
-import scipy.linalg
+import argparse
+import time
+import signal
+import socket
+import sqlite3
+import threading
+import traceback
+import multiprocessing
 import logging
 
 from contextlib import contextmanager
@@ -14,7 +18,18 @@ from contextlib import contextmanager
 from pymatgen.core.periodic_table import DummySpecie
 from pymatgen.io.gaussian import GaussianInput, GaussianOutput
 
-from tinydb import TinyDB, Query
+from store import StructureStore
+from gaussian_monitor import GaussianRun, default_rules
+from work_queue import WorkQueue
+from ledger import Ledger
+from metrics import Overheads
+from gaussian_parser import read_run_metrics
+from sizing import estimate, parse_memory, size_link0
+from nics_probes import place_probes, write_mapping
+from log_archive import LogArchive
+from archives import (Archiver, archive_name, check_compression,
+                      default_levels, extract_archive, find_archive, suffixes,
+                      write_archive)
 
 
 @contextmanager
@@ -26,27 +41,10 @@ def cd(run_path):
     if not os.path.isdir(run_path):
         os.makedirs(run_path)
     os.chdir(run_path)
-    yield
-    os.chdir(home)
-
-
-def add_dummy_atoms(mol, ring_atom_ids):
-    data = np.array([mol[i].coords for i in ring_atom_ids])
-    centre = np.average(data, axis=0)
-
-    # fit the atomic positions to a plane using least squares method, taken
-    # from: https://gist.github.com/amroamroamro/1db8d69b4b65e8bc66a6#file-curve_fitting-py-L27
-    A = np.c_[data[:, 0], data[:, 1], np.ones(data.shape[0])]
-    C, _, _, _ = scipy.linalg.lstsq(A, data[:, 2])
-
-    # calculate the normal unit vector
-    normal = np.array(np.cross([1, 0, C[0]], [0, 1, C[1]]))
-    unit = normal/scipy.linalg.norm(normal)
-
-    # add the dummy atoms above and below the ring
-    mol.append(DummySpecie('X-Bq'), centre + unit)
-    mol.append(DummySpecie('X-Bq'), centre - unit)
-    return mol
+    try:
+        yield
+    finally:
+        os.chdir(home)
 
 
 # define calculation settings
@@ -54,149 +52,981 @@ functional = 'b3lyp'
 dieze_tag = '#p'
 basis_set = '6-311++G(d,p)'
 link0 = {'%oldchk': 'chkpt.chk', '%mem': '58GB', '%nprocshared': '24'}
+# cores and memory overriding those of every g09 run of the compound, set when
+# compounds are sized to pack several on a node
+resources = {}
 td_params = {'integral': '(acc2e=12)', 'td': '(50-50)', 'guess': 'read'}
 tda_params = {'integral': '(acc2e=12)', 'tda': '(50-50)', 'guess': 'read'}
 nmr_params = {'integral': '(acc2e=12)', 'guess': 'read', 'nmr': ''}
 
-# define the rings used to calculate NICS
-six_mem_a = [0, 1, 2, 3, 4, 5]
-six_mem_b = [1, 2, 6, 7, 8, 9]
-five_mem_a = [0, 1, 9, 13, 12]
-five_mem_b = [2, 3, 10, 11, 6]
+# rules for stopping runs that are going nowhere (see gaussian_monitor), or
+# False to let them run on
+monitor_rules = dict(default_rules)
+# how many times a relaxation stopped by the monitor is restarted straight away
+monitor_restarts = 1
 
-index = int(sys.argv[1])
+# the stages run after the relaxation, in the order they are run
+stages = ('td', 'tda', 'nics_singlet', 'nics_triplet')
+stage_labels = {'td': 'TD-DFT', 'tda': 'TDA-DFT',
+                'nics_singlet': 'singlet NICS', 'nics_triplet': 'triplet NICS'}
 
-# use absolute path so we don't loose track of the db when changing directory
-db = TinyDB(os.path.abspath('structures.json'))
-query = Query()
-compound = db.get(query.index == index)
-rin = GaussianInput.from_dict(compound['input'])
-directory = rin.title
+# the state recorded in the ledger while each g09 job runs
+stage_states = {'relax': 'relax', 'td': 'td', 'tda': 'tda',
+                'nics_singlet': 'nics', 'nics_triplet': 'nics'}
 
+# the stages each stage needs to have finished first, besides the relaxation
+stage_dependencies = {'td': (), 'tda': (), 'nics_singlet': (),
+                      'nics_triplet': ()}
 
-def calculate_properties(rin, directory):
+# a --Link1-- job stops at the first error, so only a normal termination
+# ends the output of a step (see split_log)
+termination_patt = re.compile(r"Normal termination")
+# seconds between checking on the running jobs
+poll_interval = 5
 
-    with cd(directory):
+# node-local directory to run the calculations in, or None to run them in
+# calculations/, and how the archives are compressed (see archives)
+scratch = None
+compression = 'gz'
+compress_level = None
+# the single archive made by pack-archives.py in the data directory, whose
+# compounds may no longer have their own archives in calculations/
+pack_file = 'calculations.pack'
+# the titles in it, read once per worker process
+_packed_titles = None
 
-        # found that the relax often crashed or didn't finish, so will restart
-        # the calculation in these cases
-        try:
-            rout = GaussianOutput('relax.log')
-            if not rout.properly_terminated:
-                logging.info('restarting {}'.format(directory))
-                route = rout.route
-                route['integral'] = '(acc2e=12)'
-                rout.to_input('relax.com', cart_coords=True,
-                              route_parameters=route)
-                os.system('g09 < relax.com > relax.log')
-        except IOError:
-            # relaxation hasn't been run yet
-            logging.info('started processing {}'.format(directory))
-            rin.write_file('relax.com', cart_coords=True)
-            os.system('g09 < relax.com > relax.log')
-        except IndexError, AttributeError:
-            # the relax calculation used the wrong header, fix this and restart
-            rin = GaussianInput.from_file('relax.com')
-            rin.route_parameters['integral'] = '(acc2e=12)'
-            rin.write_file('relax.com', cart_coords=True)
-            os.system('g09 < relax.com > relax.log')
-
-        rout = GaussianOutput('relax.log')
+# time spent on the Python side for the compound being processed
+overheads = Overheads()
+
+
+def start_gaussian(name, entry=None, state=None):
+    """
+    Start g09 on <name>.com, moving the compound's ledger entry to the state of
+    the stage.
+    """
+    if entry is not None:
+        with overheads.timed('db'):
+            entry.transition(state or stage_states[name])
+    return GaussianRun(name, monitor_rules, poll_interval).start()
+
+
+def run_gaussian(name, entry=None, state=None):
+    """
+    Run g09 on <name>.com, stopping it early if it breaks the monitor rules,
+    and record its timings in the ledger entry.
+
+    Returns:
+        (str): Why the run was stopped early, or None.
+    """
+    run = start_gaussian(name, entry, state)
+    stopped = run.wait()
+    record_run(name, run, entry)
+    return stopped
+
+
+def record_run(name, run, entry):
+    """
+    Record the timings and resources used by a g09 run in the ledger entry.
+    """
+    if entry is None:
+        return
+    metrics = {}
+    if os.path.isfile('{}.log'.format(name)):
+        with overheads.timed('parse'), open('{}.log'.format(name), 'rb') as f:
+            log_metrics = read_run_metrics(f)
+        metrics = {'cores': log_metrics['nprocs'],
+                   'g09_cpu_time': log_metrics['cpu_time'],
+                   'scf_cycles': log_metrics['scf_cycles'],
+                   'opt_steps': log_metrics['opt_steps']}
+    if run.rusage is not None:
+        metrics['cpu_seconds'] = run.rusage.ru_utime + run.rusage.ru_stime
+        # in KB on Linux
+        metrics['max_rss'] = run.rusage.ru_maxrss / 1024.
+    with overheads.timed('db'):
+        entry.add_stage(name, run.started, run.finished, metrics)
+
+
+def record_failure(stage, reason, entry):
+    if entry is not None:
+        with overheads.timed('db'):
+            entry.transition('error', failed_stage=stage, reason=reason)
+
+
+def read_output(name):
+    with overheads.timed('parse'):
+        return GaussianOutput('{}.log'.format(name))
+
+
+def partition_link0(link0, n):
+    """
+    Split the cores and memory in the link0 parameters between n jobs.
+
+    Returns:
+        (dict): The link0 parameters for each of the jobs.
+    """
+    link0 = dict(link0)
+    if '%nprocshared' in link0:
+        link0['%nprocshared'] = str(max(1, int(link0['%nprocshared']) // n))
+    if '%mem' in link0:
+        mb = parse_memory(link0['%mem'])
+        link0['%mem'] = '{}MB'.format(max(1, int(mb // n)))
+    return link0
+
+
+def relax(rin, directory, entry=None):
+    """
+    Run, or restart, the relaxation.
+
+    Returns:
+        The GaussianOutput of the relaxation, or None if it didn't terminate
+        correctly.
+    """
+    # found that the relax often crashed or didn't finish, so will restart
+    # the calculation in these cases
+    stopped = None
+    try:
+        rout = read_output('relax')
         if not rout.properly_terminated:
-            logging.error('{} relaxation did not terminate correctly'.format(
-                          directory))
+            logging.info('restarting {}'.format(directory))
+            stopped = restart_relax(rout, entry)
+    except IOError:
+        # relaxation hasn't been run yet
+        logging.info('started processing {}'.format(directory))
+        rin.link0_parameters.update(resources)
+        rin.write_file('relax.com', cart_coords=True)
+        stopped = run_gaussian('relax', entry)
+    except (IndexError, AttributeError):
+        # the relax calculation used the wrong header, fix this and restart
+        rin = GaussianInput.from_file('relax.com')
+        rin.route_parameters['integral'] = '(acc2e=12)'
+        rin.link0_parameters.update(resources)
+        rin.write_file('relax.com', cart_coords=True)
+        stopped = run_gaussian('relax', entry)
+
+    # restart a relaxation stopped by the monitor now, rather than waiting for
+    # the compound to be run again
+    for _ in range(monitor_restarts):
+        if not stopped:
+            break
+        logging.info('restarting {} as it was stopped: {}'.format(
+                     directory, stopped))
+        try:
+            stopped = restart_relax(read_output('relax'), entry)
+        except (IndexError, AttributeError):
+            # stopped before the log had the input structure
+            break
+
+    if stopped:
+        logging.error('{} relaxation was stopped: {}'.format(directory,
+                                                            stopped))
+        record_failure('relax', 'stopped: {}'.format(stopped), entry)
+        return None
+    rout = read_output('relax')
+    if not rout.properly_terminated:
+        logging.error('{} relaxation did not terminate correctly'.format(
+                      directory))
+        record_failure('relax', 'did not terminate correctly', entry)
+        return None
+    return rout
+
+
+def restart_relax(rout, entry=None):
+    """
+    Restart a relaxation from the last structure in its log.
+    """
+    route = rout.route_parameters
+    route['integral'] = '(acc2e=12)'
+    rin = rout.to_input(cart_coords=True, route_parameters=route,
+                        link0_parameters=dict(rout.link0, **resources))
+    rin.write_file('relax.com', cart_coords=True)
+    return run_gaussian('relax', entry)
+
+
+def stage_inputs(rin, rout):
+    """
+    Make the inputs for the stages that follow the relaxation, writing the
+    mapping of the NICS probes to their rings (see nics_probes) in the
+    current directory.
+
+    Returns:
+        (dict): The GaussianInput for each stage as {stage: input}.
+    """
+    link0_stage = dict(link0, **resources)
+    # do the TD-DFT calculation
+    tdin = GaussianInput(rout.final_structure, charge=0, title=rin.title,
+                         functional=functional, spin_multiplicity=1,
+                         basis_set=basis_set, dieze_tag=dieze_tag,
+                         link0_parameters=link0_stage,
+                         route_parameters=td_params)
+
+    # do the TD-DFT calculation w. Tamm-Dancoff approx
+    tdain = GaussianInput(rout.final_structure, charge=0, title=rin.title,
+                          spin_multiplicity=1, functional=functional,
+                          basis_set=basis_set, dieze_tag=dieze_tag,
+                          link0_parameters=link0_stage,
+                          route_parameters=tda_params)
+
+    # add the dummy atoms for the NICS(1)_zz calculations, on a copy as the
+    # TD-DFT inputs share the final structure, and record which ring each is
+    # for, for extract-data.py
+    mol_nics = rout.final_structure.copy()
+    (probes, mapping), = place_probes(
+        [([str(s) for s in mol_nics.species], mol_nics.cart_coords)])
+    for coords in probes:
+        mol_nics.append(DummySpecie('X-Bq'), coords)
+    write_mapping(mapping)
+
+    # run NICS on the ground state and triplet state
+    nicssin = GaussianInput(mol_nics, charge=0, title=rin.title,
+                            spin_multiplicity=1, functional=functional,
+                            basis_set=basis_set, dieze_tag=dieze_tag,
+                            link0_parameters=link0_stage,
+                            route_parameters=nmr_params)
+    nicstin = GaussianInput(mol_nics, charge=0, title=rin.title,
+                            spin_multiplicity=3, functional=functional,
+                            basis_set=basis_set, dieze_tag=dieze_tag,
+                            link0_parameters=link0_stage,
+                            route_parameters=nmr_params)
+    return {'td': tdin, 'tda': tdain, 'nics_singlet': nicssin,
+            'nics_triplet': nicstin}
+
+
+def write_input(name, gin):
+    filename = '{}.com'.format(name)
+    gin.write_file(filename, cart_coords=True)
+    # work around as pymatgen does not allow Bq as an element
+    if name.startswith('nics'):
+        with open(filename) as f:
+            content = f.read()
+        with open(filename, 'w') as f:
+            f.write(content.replace('X-Bq0+', 'Bq'))
+
+
+def stage_done(name):
+    """
+    Check whether a stage has already terminated properly.
+    """
+    # can't have NICS job completion check due to above mentioned pmg bug, so
+    # these are always rerun
+    if name.startswith('nics') or not os.path.isfile('{}.log'.format(name)):
+        return False
+    return read_output(name).properly_terminated
+
+
+def check_stage(name, directory, stopped=None, entry=None):
+    """
+    Check a stage that has just been run, logging an error if it failed.
+
+    Args:
+        stopped (str): Why the monitor stopped the run, if it did.
+    """
+    if stopped:
+        logging.error('{} {} was stopped: {}'.format(
+                      directory, stage_labels[name], stopped))
+        record_failure(name, 'stopped: {}'.format(stopped), entry)
+        return False
+    if name.startswith('nics'):
+        return True
+    if not read_output(name).properly_terminated:
+        logging.error('{} {} did not terminate correctly'.format(
+                      directory, stage_labels[name]))
+        record_failure(name, 'did not terminate correctly', entry)
+        return False
+    return True
+
+
+def run_concurrently(pending, inputs, directory, slots, entry=None):
+    """
+    Run the stages, running up to slots of them at the same time.
+
+    A stage is started once the stages it depends on have finished, with the
+    node's cores and memory split evenly between the slots. Each stage reads
+    its own copy of the relaxation checkpoint, so the jobs don't contend for
+    the same file. Once a stage fails no more are started, but those already
+    running are left to finish so their logs can be used on a restart.
+
+    Returns:
+        (bool): Whether all the stages terminated correctly.
+    """
+    slots = max(1, min(slots, len(pending)))
+    link0_stage = partition_link0(dict(link0, **resources), slots)
+    waiting = list(pending)
+    finished = set(stage for stage in stages if stage not in pending)
+    running = {}
+    ok = True
+
+    try:
+        while running or (waiting and ok):
+            ready = [name for name in waiting if
+                     all(dep in finished for dep in stage_dependencies[name])]
+            while ok and ready and len(running) < slots:
+                name = ready.pop(0)
+                waiting.remove(name)
+                gin = inputs[name]
+                gin.link0_parameters = dict(link0_stage)
+                gin.link0_parameters['%oldchk'] = '{}.chk'.format(name)
+                if os.path.isfile(link0['%oldchk']):
+                    shutil.copyfile(link0['%oldchk'], '{}.chk'.format(name))
+                write_input(name, gin)
+                logging.info('{} started {} with {} cores'.format(
+                    directory, stage_labels[name],
+                    link0_stage['%nprocshared']))
+                running[name] = start_gaussian(name, entry)
+
+            if not running:
+                # the remaining stages depend on a stage that can't run
+                break
+            done = [name for name, run in running.items()
+                    if run.poll() is not None]
+            if not done:
+                time.sleep(poll_interval)
+                continue
+            for name in done:
+                run = running.pop(name)
+                record_run(name, run, entry)
+                if os.path.isfile('{}.chk'.format(name)):
+                    os.remove('{}.chk'.format(name))
+                finished.add(name)
+                ok = check_stage(name, directory, run.reason, entry) and ok
+    except BaseException:
+        # don't leave g09 running if we're stopped
+        for run in running.values():
+            run.kill()
+        raise
+    return ok and not waiting
+
+
+def split_log(log, names):
+    """
+    Split the log of a --Link1-- job into a log for each step.
+
+    The output of each step that finished ends with its normal termination
+    message. Everything after the last one goes in the log of the step that
+    was running, whether it ended with an error, whose message can run over
+    several lines, or the job was killed, so that it isn't seen as properly
+    terminated.
+
+    Returns:
+        (list): The names of the steps that were run.
+    """
+    sections = [[]]
+    with open(log) as f:
+        for line in f:
+            sections[-1].append(line)
+            if termination_patt.search(line):
+                sections.append([])
+    written = []
+    for name, lines in zip(names, sections):
+        if lines:
+            with open('{}.log'.format(name), 'w') as f:
+                f.writelines(lines)
+            written.append(name)
+    return written
+
+
+def calculate_properties(rin, directory, link1=False, concurrent=1,
+                         entry=None):
+    """
+    Run all the calculations for a compound in its directory.
+
+    Args:
+        rin (GaussianInput): The input for the relaxation.
+        directory (str): The directory to run the calculations in.
+        link1 (bool): Run all the stages after the relaxation as a single
+            g09 job, chained with --Link1-- and sharing the checkpoint. The log
+            is split back into a log per stage, so the restart checks are the
+            same as when running them separately.
+        concurrent (int): The number of independent stages after the
+            relaxation to run at the same time, splitting the cores and
+            memory between them.
+        entry (LedgerEntry): Where to record the progress of the compound.
+
+    Returns:
+        (int): 1 if all the calculations finished, otherwise 0.
+    """
+    with cd(directory):
+        rout = relax(rin, directory, entry)
+        if not rout:
             return 0
 
-        # do the TD-DFT calculation
-        tdin = GaussianInput(rout.final_structure, charge=0, title=rin.title,
-                             functional=functional, spin_multiplicity=1,
-                             basis_set=basis_set, dieze_tag=dieze_tag,
-                             link0_parameters=link0, route_parameters=td_params)
-        td_done = False
-        if os.path.isfile('td.log'):
-            tdout = GaussianOutput('td.log')
-            if tdout.properly_terminated:
-                td_done = True
-
-        if not td_done:
-            tdin.write_file('td.com', cart_coords=True)
-            os.system('g09 < td.com > td.log')
-            tdout = GaussianOutput('td.log')
-            if not tdout.properly_terminated:
-                logging.error('{} TD-DFT did not terminate correctly'.format(
-                              directory))
-                return 0
+        inputs = stage_inputs(rin, rout)
+        pending = [name for name in stages if not stage_done(name)]
 
-        # do the TD-DFT calculation w. Tamm-Dancoff approx
-        tdain = GaussianInput(rout.final_structure, charge=0, title=rin.title,
-                              spin_multiplicity=1, functional=functional,
-                              basis_set=basis_set, dieze_tag=dieze_tag,
-                              link0_parameters=link0,
-                              route_parameters=tda_params)
-        tda_done = False
-        if os.path.isfile('tda.log'):
-            tdaout = GaussianOutput('tda.log')
-            if tdaout.properly_terminated:
-                tda_done = True
-
-        if not tda_done:
-            tdain.write_file('tda.com', cart_coords=True)
-            os.system('g09 < tda.com > tda.log')
-            tdaout = GaussianOutput('tda.log')
-            if not tdaout.properly_terminated:
-                logging.error('{} TDA-DFT did not terminate correctly'.format(
-                              directory))
-                return 0
+        if link1 and pending:
+            for name in pending:
+                write_input(name, inputs[name])
+            sections = []
+            for name in pending:
+                with open('{}.com'.format(name)) as f:
+                    sections.append(f.read().rstrip('\n') + '\n\n')
+            with open('chain.com', 'w') as f:
+                f.write('--Link1--\n'.join(sections))
+            stopped = run_gaussian('chain', entry,
+                                   state=stage_states[pending[0]])
+            ran = split_log('chain.log', pending)
+            os.remove('chain.log')
 
-        # add the dummy atoms for the NICS(1)_zz calculations
-        mol_nics = rout.final_structure
-        mol_nics = add_dummy_atoms(mol_nics, six_mem_a)
-        mol_nics = add_dummy_atoms(mol_nics, six_mem_b)
-        mol_nics = add_dummy_atoms(mol_nics, five_mem_a)
-        mol_nics = add_dummy_atoms(mol_nics, five_mem_b)
-
-        # run NICS on the ground state and triplet state
-        nicssin = GaussianInput(mol_nics, charge=0, title=rin.title,
-                                spin_multiplicity=1, functional=functional,
-                                basis_set=basis_set, dieze_tag=dieze_tag,
-                                link0_parameters=link0,
-                                route_parameters=nmr_params)
-        nicssin.write_file('nics_singlet.com', cart_coords=True)
-        # work around as pymatgen does not allow Bq as an element
-        os.system("sed -i 's/X-Bq0+/Bq/g' nics_singlet.com")
-        os.system('g09 < nics_singlet.com > nics_singlet.log')
-        # can't have NICS job completion check due to above mentioned pmg bug
-
-        nicstin = GaussianInput(mol_nics, charge=0, title=rin.title,
-                                spin_multiplicity=3, functional=functional,
-                                basis_set=basis_set, dieze_tag=dieze_tag,
-                                link0_parameters=link0,
-                                route_parameters=nmr_params)
-        nicstin.write_file('nics_triplet.com', cart_coords=True)
-        os.system("sed -i 's/X-Bq0+/Bq/g' nics_triplet.com")
-        os.system('g09 < nics_triplet.com > nics_triplet.log')
+            # g09 stops at the first step that fails, same as running them
+            # one after another, and if the monitor stopped it, it was the
+            # last step that was running
+            last = ran[-1] if ran else None
+            for name in pending:
+                if not check_stage(name, directory,
+                                   stopped if name == last else None, entry):
+                    return 0
+        elif concurrent > 1 and pending:
+            if not run_concurrently(pending, inputs, directory, concurrent,
+                                    entry):
+                return 0
+        else:
+            for name in pending:
+                write_input(name, inputs[name])
+                stopped = run_gaussian(name, entry)
+                if not check_stage(name, directory, stopped, entry):
+                    return 0
     logging.info('finished processing {}'.format(directory))
     return 1
 
-with cd('calculations'):
-    logging.basicConfig(filename='calculations.log', level=logging.DEBUG)
 
-    tar_file = '{}.tar.gz'.format(directory)
-    error_tar_file = '{}_error.tar.gz'.format(directory)
+def packed_titles():
+    """
+    Get the titles of the compounds in the pack, which only ever gains
+    finished compounds, so it is read once per process. This needs to be run
+    from the data directory.
+    """
+    global _packed_titles
+    if _packed_titles is None:
+        _packed_titles = set()
+        if os.path.isfile(pack_file + '.idx'):
+            with LogArchive(os.path.abspath(pack_file),
+                            readonly=True) as archive:
+                _packed_titles = archive.titles()
+    return _packed_titles
+
+
+def process_compound(index, link1=False, concurrent=1, archiver=None):
+    """
+    Calculate the properties of a compound and archive the calculations.
+
+    This needs to be run from the data directory, which contains the structure
+    store, the ledger and the calculations directory. The calculations are run
+    in calculations/<title>, or in <scratch>/<title> if a scratch directory is
+    set, and archived to calculations/ once they're done.
+
+    Args:
+        archiver (Archiver): Archive the calculations in the background
+            rather than before returning. The compound's ledger entry is then
+            left for the caller to move to archived, once the archiver has
+            given back the index.
+
+    Returns:
+        (int): 1 if the compound is finished, or has nothing to calculate,
+        otherwise 0.
+    """
+    overheads.reset()
+
+    # use absolute path so we don't loose track of the db when changing
+    # directory
+    with overheads.timed('db'):
+        with StructureStore(os.path.abspath('structures.db'),
+                            readonly=True) as db:
+            compound = db.get(index)
+        ledger = Ledger(os.path.abspath('ledger.db'))
+
+    with ledger:
+        entry = ledger.entry(index, compound['title'])
+
+        # structures equivalent to one with a lower index are not calculated,
+        # their results are taken from the representative when extracting the
+        # data
+        if compound.get('alias_of'):
+            print('{} is equivalent to structure {}, skipping'.format(
+                  compound['title'], compound['alias_of']))
+            entry.transition('alias')
+            return 1
+
+        rin = GaussianInput.from_dict(compound['input'])
+        directory = rin.title
+
+        # packed with its archive removed (see pack-archives.py --remove)
+        if directory in packed_titles():
+            entry.transition('archived')
+            return 1
+
+        with cd('calculations'):
+            logging.basicConfig(filename='calculations.log',
+                                level=logging.DEBUG)
+
+            if find_archive('.', directory):
+                entry.transition('archived')
+                return 1
+
+            run_directory = directory
+            if scratch is not None:
+                run_directory = os.path.join(scratch, directory)
+                # carry on from a run that wasn't in scratch
+                if os.path.isdir(directory) and \
+                        not os.path.isdir(run_directory):
+                    shutil.move(directory, run_directory)
+
+            error_archive = find_archive('.', directory, error=True)
+            if error_archive and os.path.isdir(run_directory):
+                os.remove(error_archive)
+            elif error_archive:
+                with overheads.timed('tar'):
+                    extract_archive(error_archive,
+                                    os.path.dirname(run_directory) or '.')
+                os.remove(error_archive)
+
+            try:
+                finished = calculate_properties(
+                    rin, run_directory, link1=link1, concurrent=concurrent,
+                    entry=entry)
+            except BaseException as e:
+                # signals and SystemExit aren't failures of the compound
+                if isinstance(e, Exception):
+                    record_failure(None, repr(e), entry)
+                # copy what has been done back from scratch, so it can be
+                # carried on from by whichever worker takes the compound next
+                if scratch is not None and os.path.isdir(run_directory):
+                    write_archive(archive_name(directory, compression,
+                                               error=True),
+                                  run_directory, compress_level)
+                    shutil.rmtree(run_directory)
+                raise
+
+            filename = os.path.abspath(archive_name(
+                directory, compression, error=not finished))
+            if archiver is not None:
+                archiver.add(run_directory, filename, index)
+            else:
+                with overheads.timed('tar'):
+                    write_archive(filename, run_directory, compress_level)
+                shutil.rmtree(run_directory)
+                with overheads.timed('db'):
+                    if finished:
+                        entry.transition('archived')
+            entry.add_overheads(overheads.seconds)
+    return finished
+
+
+class Lease(threading.Thread):
+    """
+    Keep renewing a worker's claim on a compound while it is calculated.
+    """
+
+    def __init__(self, queue_file, index, worker, lease):
+        super(Lease, self).__init__()
+        self.daemon = True
+        self.queue_file = queue_file
+        self.index = index
+        self.worker = worker
+        self.lease = lease
+        self.stopped = threading.Event()
+
+    def run(self):
+        # sqlite connections can't be shared between threads
+        with WorkQueue(self.queue_file) as queue:
+            while not self.stopped.wait(self.lease / 3.):
+                try:
+                    renewed = queue.renew(self.index, self.worker, self.lease)
+                except sqlite3.OperationalError as e:
+                    # e.g. the database is locked by a busy worker, so try
+                    # again next time, while the lease still has time to run
+                    logging.warning('{} could not renew its claim on {}: {}'
+                                    .format(self.worker, self.index, e))
+                    continue
+                if not renewed:
+                    logging.warning('{} lost its claim on {}'.format(
+                                    self.worker, self.index))
+                    return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def parse_walltime(walltime):
+    """
+    Convert a walltime given as seconds or [[HH:]MM:]SS to seconds.
+    """
+    seconds = 0
+    for part in walltime.split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def parse_rule(rule):
+    """
+    Parse a monitor rule given as NAME=VALUE, where a VALUE of none turns the
+    rule off.
+    """
+    name, _, value = rule.partition('=')
+    if name not in default_rules or not value:
+        raise argparse.ArgumentTypeError('invalid rule: {}'.format(rule))
+    if value.lower() == 'none':
+        return name, None
+    try:
+        return name, float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid rule: {}'.format(rule))
+
+
+def _terminate(signum, frame):
+    raise SystemExit('received signal {}'.format(signum))
+
+
+def run_worker(queue_file, walltime=None, lease=600, link1=False,
+               concurrent=1):
+    """
+    Process compounds claimed from the shared queue until there are none left
+    or the walltime is nearly used up.
+
+    Rather than a job per compound, a few long running workers are submitted,
+    which saves the queueing and start up time of each. The queue is filled
+    with the compounds in the structure store the first time it is used.
+    Compounds are only claimed while there is still time for the longest one
+    processed so far (or a tenth of the walltime before the first has
+    finished), as one that is cut short has to be restarted.
+
+    Args:
+        queue_file (str): Path to the queue database.
+        walltime (float): Seconds the worker can run for, or None for no
+            limit.
+        lease (float): Seconds a claim lasts without being renewed. Claims are
+            renewed every lease / 3 seconds while the compound is processed,
+            so a compound is only taken by another worker once its worker has
+            stopped.
+    """
+    start = time.time()
+    worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+    queue_file = os.path.abspath(queue_file)
+    # make sure the claim is given back if the scheduler stops the job
+    signal.signal(signal.SIGTERM, _terminate)
+
+    with StructureStore(os.path.abspath('structures.db'), readonly=True) as db:
+        indices = sorted(db.indices())
+
+    with Ledger(os.path.abspath('ledger.db')) as ledger:
+        ledger.queue(indices)
+
+    # with node-local scratch, each compound is archived back to the shared
+    # filesystem while the next one is calculated, keeping its claim until
+    # then
+    archiver = None
+    if scratch is not None:
+        archiver = Archiver(compress_level)
+        archiver.start()
+    archiving = {}
+
+    with WorkQueue(queue_file) as queue:
+        queue.add(indices)
+        longest = 0
+        try:
+            while True:
+                if archiver is not None:
+                    collect_archived(archiver, archiving, queue, worker)
+                if walltime is not None:
+                    remaining = walltime - (time.time() - start)
+                    if remaining < max(longest, 0.1 * walltime):
+                        print('{} stopping with {:.0f} s of walltime '
+                              'left'.format(worker, remaining))
+                        break
+                index = queue.claim(worker, lease)
+                if index is None:
+                    print('{} found no more compounds to calculate'.format(
+                          worker))
+                    break
+
+                compound_start = time.time()
+                heartbeat = Lease(queue_file, index, worker, lease)
+                heartbeat.start()
+                state = 'error'
+                try:
+                    if process_compound(index, link1=link1,
+                                        concurrent=concurrent,
+                                        archiver=archiver):
+                        state = 'done'
+                except Exception:
+                    # keep going with the other compounds
+                    traceback.print_exc()
+                except BaseException:
+                    heartbeat.stop()
+                    queue.release(index, worker)
+                    with Ledger(os.path.abspath('ledger.db')) as ledger:
+                        ledger.transition(index, 'queued')
+                    raise
+                if archiver is not None and index in archiver.pending:
+                    archiving[index] = (heartbeat, state)
+                else:
+                    heartbeat.stop()
+                    queue.finish(index, worker, state)
+                longest = max(longest, time.time() - compound_start)
+        finally:
+            if archiver is not None:
+                # the compounds already calculated still need archiving
+                archiver.close()
+                collect_archived(archiver, archiving, queue, worker)
+
+
+def collect_archived(archiver, archiving, queue, worker):
+    """
+    Finish the compounds the archiver has archived since it was last checked.
+
+    Args:
+        archiving (dict): The lease and queue state of each compound waiting
+            to be archived, as {index: (lease, state)}.
+    """
+    done = archiver.finished()
+    if not done:
+        return
+    with Ledger(os.path.abspath('ledger.db')) as ledger:
+        for index, seconds, error in done:
+            heartbeat, state = archiving.pop(index)
+            if error:
+                print('{} could not archive {}:\n{}'.format(worker, index,
+                                                             error))
+                ledger.transition(index, 'error', failed_stage='archive',
+                                  reason='could not be archived')
+                state = 'error'
+            elif state == 'done':
+                ledger.transition(index, 'archived')
+            ledger.add_overheads([(index, 'tar', seconds)])
+            heartbeat.stop()
+            queue.finish(index, worker, state)
+
+
+def compound_size(compound, node_cores, node_mem_mb):
+    """
+    Estimate the cores and memory for a compound from its record in the
+    structure store (see sizing.estimate), or None if it isn't calculated.
+    """
+    if compound.get('alias_of'):
+        return None
+    species = [site['species'][0]['element']
+               for site in compound['input']['molecule']['sites']]
+    return estimate(species, node_cores, node_mem_mb)
+
+
+# seconds a packed compound's process is given to stop before it is killed
+shutdown_timeout = 120
+
+# the settings a packed compound's process is started with, as it is a fresh
+# process that doesn't see those set from the command line
+_packed_settings = ('link0', 'monitor_rules', 'monitor_restarts',
+                    'poll_interval', 'scratch', 'compression', 'compress_level')
+
+
+def _process_sized(index, size, link1, concurrent, settings):
+    """
+    Process a compound with the resources it was sized for, as the target of
+    a process started by run_packing_worker.
+    """
+    global resources
+    globals().update(settings)
+    signal.signal(signal.SIGTERM, _terminate)
+    # in a process of its own, so the other compounds keep their sizes
+    if size is not None:
+        resources = size_link0(size)
+    raise SystemExit(0 if process_compound(index, link1=link1,
+                                           concurrent=concurrent) else 1)
+
+
+def run_packing_worker(queue_file, walltime=None, lease=600, link1=False,
+                       concurrent=1):
+    """
+    Process compounds claimed from the shared queue like run_worker, but run
+    several at once on the node, each with the cores and memory estimated for
+    it by the sizing model.
+
+    The compounds are taken in the order of the queue, and each is started in
+    a process of its own as soon as enough of the node's cores and memory (as
+    given by link0) are free, so smaller compounds share a node rather than
+    each having one to itself.
+    """
+    start = time.time()
+    worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+    queue_file = os.path.abspath(queue_file)
+    signal.signal(signal.SIGTERM, _terminate)
+    node_cores = int(link0['%nprocshared'])
+    node_mem_mb = parse_memory(link0['%mem'])
+    # spawned rather than forked, as a process forked while the leases'
+    # threads use sqlite can deadlock, so the settings are passed on
+    context = multiprocessing.get_context('spawn')
+    settings = dict((name, globals()[name]) for name in _packed_settings)
+
+    db = StructureStore(os.path.abspath('structures.db'), readonly=True)
+    indices = sorted(db.indices())
+
+    with Ledger(os.path.abspath('ledger.db')) as ledger:
+        ledger.queue(indices)
+
+    # the process, lease, size and start time of each compound being run
+    running = {}
+    # a compound that has been claimed but is waiting for room on the node,
+    # whose claim is renewed here until its lease is started with it
+    waiting = None
+    stopping = False
+    longest = 0
+    with db, WorkQueue(queue_file) as queue:
+        queue.add(indices)
+        try:
+            while True:
+                for index in [index for index, (process, _, _, _) in
+                              running.items() if not process.is_alive()]:
+                    process, heartbeat, _, compound_start = running.pop(index)
+                    process.join()
+                    heartbeat.stop()
+                    queue.finish(index, worker,
+                                 'done' if process.exitcode == 0 else 'error')
+                    longest = max(longest, time.time() - compound_start)
+
+                if waiting is None and not stopping:
+                    remaining = None
+                    if walltime is not None:
+                        remaining = walltime - (time.time() - start)
+                    if remaining is not None and \
+                            remaining < max(longest, 0.1 * walltime):
+                        print('{} stopping with {:.0f} s of walltime '
+                              'left'.format(worker, remaining))
+                        stopping = True
+                    else:
+                        index = queue.claim(worker, lease)
+                        if index is None:
+                            print('{} found no more compounds to '
+                                  'calculate'.format(worker))
+                            stopping = True
+                        else:
+                            waiting = (index, compound_size(
+                                db.get(index), node_cores, node_mem_mb))
+
+                if waiting is not None and \
+                        not queue.renew(waiting[0], worker, lease):
+                    logging.warning('{} lost its claim on {}'.format(
+                                    worker, waiting[0]))
+                    waiting = None
+                    continue
 
-    if os.path.isfile(tar_file):
-        sys.exit()
-    elif os.path.isfile(error_tar_file) and os.path.isdir(directory):
-        os.remove(error_tar_file)
-    elif os.path.isfile(error_tar_file):
-        with tarfile.open(error_tar_file) as tar:
-            tar.extractall()
-        os.remove(error_tar_file)
+                if waiting is not None:
+                    index, size = waiting
+                    sizes = [s for _, _, s, _ in running.values() if s]
+                    if size is None or (
+                            sum(s['cores'] for s in sizes) + size['cores'] <=
+                            node_cores and
+                            sum(s['mem_mb'] for s in sizes) + size['mem_mb'] <=
+                            node_mem_mb):
+                        if size is not None:
+                            print('{} started {} with {} cores and {} MB for '
+                                  '{} basis functions'.format(
+                                      worker, index, size['cores'],
+                                      size['mem_mb'], size['basis_functions']))
+                        process = context.Process(
+                            target=_process_sized,
+                            args=(index, size, link1, concurrent, settings))
+                        process.start()
+                        heartbeat = Lease(queue_file, index, worker, lease)
+                        heartbeat.start()
+                        running[index] = (process, heartbeat, size,
+                                          time.time())
+                        waiting = None
+                        continue
+                elif stopping and not running:
+                    break
+                time.sleep(poll_interval)
+        except BaseException:
+            # give the claims back, stopping the compounds being run
+            for process, _, _, _ in running.values():
+                process.terminate()
+            for index, (process, heartbeat, _, _) in running.items():
+                # give them time to copy their runs back from scratch
+                process.join(shutdown_timeout)
+                if process.is_alive():
+                    logging.warning('{} killing {} as it did not stop'.format(
+                                    worker, index))
+                    process.kill()
+                    process.join()
+                heartbeat.stop()
+                queue.release(index, worker)
+            if waiting is not None:
+                queue.release(waiting[0], worker)
+            with Ledger(os.path.abspath('ledger.db')) as ledger:
+                for index in running:
+                    ledger.transition(index, 'queued')
+            raise
 
-    finished = calculate_properties(rin, directory)
-    filename = tar_file if finished == 1 else error_tar_file
 
-    os.remove(os.path.join(directory, 'chkpt.chk'))
-    with tarfile.open(filename, "w:gz") as tar:
-        tar.add(directory)
-    shutil.rmtree(directory)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Calculate the properties of a compound.')
+    parser.add_argument('index', type=int, nargs='?',
+                        help='index of the compound in the structure store')
+    parser.add_argument('--worker', action='store_true',
+                        help='keep claiming compounds from the shared queue '
+                             'instead of processing a single index')
+    parser.add_argument('--queue', default='queue.db',
+                        help='queue database used by the workers '
+                             '(default: queue.db)')
+    parser.add_argument('--walltime', type=parse_walltime,
+                        help='walltime of the worker as seconds or HH:MM:SS')
+    parser.add_argument('--lease', type=float, default=600,
+                        help='seconds before the claim of a worker that has '
+                             'stopped responding runs out (default: 600)')
+    parser.add_argument('--pack', action='store_true',
+                        help='size each compound by its basis functions and '
+                             'run as many at once as fit on the node '
+                             '(with --worker)')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--link1', action='store_true',
+                      help='run the stages after the relaxation as a single '
+                           'g09 job chained with --Link1--')
+    mode.add_argument('-j', '--concurrent', type=int, default=1,
+                      help='number of stages after the relaxation to run at '
+                           'the same time, splitting the cores and memory '
+                           'between them (default: 1)')
+    parser.add_argument('--rule', type=parse_rule, action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='change a rule for stopping runs early, e.g. '
+                             'max_scf_cycles=128 or stall_timeout=14400 '
+                             '(rules: {})'.format(
+                                 ', '.join(sorted(default_rules))))
+    parser.add_argument('--no-monitor', action='store_true',
+                        help="don't stop runs early")
+    parser.add_argument('--scratch', metavar='DIR',
+                        help='run the calculations in node-local DIR, only '
+                             'copying the archives back to calculations/ '
+                             '(in the background with --worker)')
+    parser.add_argument('--compression', choices=sorted(suffixes),
+                        default='gz',
+                        help='compression of the archives, zst needs the '
+                             'zstandard package (default: gz)')
+    parser.add_argument('--compress-level', type=int,
+                        help='compression level (default: {})'.format(
+                            ', '.join('{} for {}'.format(level, name)
+                                      for name, level in
+                                      sorted(default_levels.items()))))
+    args = parser.parse_args()
+    try:
+        check_compression(args.compression)
+    except ValueError as e:
+        parser.error(str(e))
+    compression = args.compression
+    compress_level = args.compress_level
+    if args.scratch:
+        scratch = os.path.abspath(args.scratch)
+    monitor_rules.update(args.rule)
+    if args.no_monitor:
+        monitor_rules = False
+    if args.pack and not args.worker:
+        parser.error('--pack needs --worker')
+    if args.pack:
+        run_packing_worker(args.queue, walltime=args.walltime,
+                           lease=args.lease, link1=args.link1,
+                           concurrent=args.concurrent)
+    elif args.worker:
+        run_worker(args.queue, walltime=args.walltime, lease=args.lease,
+                   link1=args.link1, concurrent=args.concurrent)
+    elif args.index is None:
+        parser.error('either an index or --worker is needed')
+    else:
+        process_compound(args.index, link1=args.link1,
+                         concurrent=args.concurrent)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+"""
+Report the progress of the calculations from the ledger.
+
+usage: check-status.py [--ledger ../data/ledger.db]
+                       [--db ../data/structures.db] [--failed 10]
+"""
+
+import os
+import time
+import argparse
+
+from ledger import Ledger, running_states
+from store import StructureStore
+
+
+def format_duration(seconds):
+    hours, seconds = divmod(int(seconds), 3600)
+    return '{}:{:02d}:{:02d}'.format(hours, seconds // 60, seconds % 60)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--ledger', default='../data/ledger.db')
+    parser.add_argument('--db', default='../data/structures.db',
+                        help='structure store, for the total number of '
+                             'compounds')
+    parser.add_argument('--failed', type=int, default=0, metavar='N',
+                        help='list the N most recent failures')
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.ledger):
+        parser.error('no ledger at {}'.format(args.ledger))
+    total = None
+    if os.path.isfile(args.db):
+        with StructureStore(args.db, readonly=True) as db:
+            total = len(db)
+
+    with Ledger(args.ledger) as ledger:
+        status = ledger.status(total)
+        failed = ledger.failed(args.failed) if args.failed else []
+
+    counts = status['counts']
+    print(time.strftime('%c'))
+    print('{} compounds, {} equivalent to another so not calculated'.format(
+          sum(counts.values()), counts['alias']))
+    print('{} have completed successfully'.format(counts['archived']))
+    print('{} calculations terminated incorrectly'.format(counts['error']))
+    for stage, n in sorted(status['failures'].items()):
+        print('    {:>6} in {}'.format(n, stage))
+    print('{} are running ({})'.format(
+          sum(counts[state] for state in running_states),
+          ', '.join('{} {}'.format(counts[state], state)
+                    for state in running_states)))
+    print('{} are queued'.format(counts['queued']))
+
+    if status['stage_times']:
+        print('mean time per job:')
+        for stage, seconds in sorted(status['stage_times'].items()):
+            print('    {:>12} {}'.format(stage, format_duration(seconds)))
+    if status['rate']:
+        print('{:.1f} compounds finished per hour, {} to go'.format(
+              status['rate'], format_duration(status['eta'])))
+
+    for index, title, stage, reason in failed:
+        print('{:>8} {} {}: {}'.format(index, title, stage, reason))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""
+Detect structures that are the same molecule.
+
+Two levels of equivalence are available:
+
+geometry: the structures are the same up to a rotation, translation or
+    permutation of the atoms, i.e. they would give identical results. The
+    fingerprint only narrows down the candidates, being that of the bond
+    graph (below), and a structure is equivalent to a candidate if, for each
+    pair of elements, their sorted interatomic distances agree to within
+    geometry_tolerance. Comparing within a tolerance, rather than hashing
+    rounded distances, means two equivalent structures can't be told apart by
+    distances falling either side of a rounding boundary.
+graph: the bond graphs, with the atoms labelled by element, are isomorphic.
+    This also merges conformers, e.g. the ny=1 and ny=5 pyridyl rings differ
+    only by a rotation of the ring, which will not necessarily relax to the
+    same minimum. The fingerprint is a Weisfeiler-Lehman hash: each atom label
+    is repeatedly replaced by a hash of itself and the sorted labels of its
+    neighbours, and the fingerprint is a hash of the final sorted labels.
+
+Representatives keeps the first structure of each equivalence class, to find
+which class each new structure belongs to.
+"""
+
+import hashlib
+
+import numpy as np
+
+# covalent radii in Angstrom, from Cordero et al., Dalton Trans., 2008, 2832
+covalent_radii = {'H': 0.31, 'B': 0.84, 'C': 0.76, 'N': 0.71, 'O': 0.66,
+                  'F': 0.57, 'Si': 1.11, 'P': 1.07, 'S': 1.05, 'Cl': 1.02,
+                  'Se': 1.20, 'Br': 1.20, 'I': 1.39}
+elements = sorted(covalent_radii)
+
+# atoms are bonded if closer than this factor times the sum of their radii,
+# which leaves out close contacts such as between neighbouring nitro groups
+bond_tolerance = 1.2
+# the largest difference in Angstrom between the interatomic distances of
+# geometrically equivalent structures; the closest inequivalent structures in
+# the library, the ny=1 and ny=5 conformers, differ by 0.1 A
+geometry_tolerance = 0.01
+# larger than any interatomic distance, see geometry_descriptor
+pair_offset = 1000.
+
+
+def _distances(coords):
+    coords = np.asarray(coords)
+    return np.linalg.norm(coords[:, None, :] - coords[None, :, :], axis=2)
+
+
+def _hash(label):
+    return hashlib.sha1(label.encode('utf-8')).hexdigest()
+
+
+def bond_graph(species, coords):
+    """
+    Get the bonded neighbours of each atom as a list of index arrays.
+    """
+    radii = np.array([covalent_radii[s] for s in species])
+    bonded = _distances(coords) < bond_tolerance * (radii[:, None] +
+                                                    radii[None, :])
+    np.fill_diagonal(bonded, False)
+    return [np.flatnonzero(row) for row in bonded]
+
+
+def graph_fingerprint(species, coords):
+    """
+    Get the Weisfeiler-Lehman fingerprint of the bond graph of a structure.
+    """
+    neighbours = bond_graph(species, coords)
+    labels = [str(s) for s in species]
+    n_classes = len(set(labels))
+    # stop once the labels no longer split the atoms into more classes
+    for _ in range(len(labels)):
+        labels = [_hash(labels[i] + ''.join(sorted(labels[j] for j in nn)))
+                  for i, nn in enumerate(neighbours)]
+        if len(set(labels)) == n_classes:
+            break
+        n_classes = len(set(labels))
+    return 'graph-' + _hash(','.join(sorted(labels)))
+
+
+def geometry_fingerprint(species, coords):
+    """
+    Get the fingerprint used to find the candidates for geometric
+    equivalence, see same_geometry.
+    """
+    return 'geometry-' + graph_fingerprint(species, coords)[len('graph-'):]
+
+
+def geometry_descriptor(species, coords):
+    """
+    Get the sorted interatomic distances of each pair of elements, in the
+    order of the elements, which don't depend on the orientation of the
+    structure or the order of its atoms. Each distance is offset by
+    pair_offset times a code for its pair of elements, so a single sort
+    groups them by pair.
+    """
+    z = np.array([elements.index(s) for s in species])
+    i, j = np.triu_indices(len(z), 1)
+    pairs = np.minimum(z[i], z[j]) * len(elements) + np.maximum(z[i], z[j])
+    return np.sort(pairs * pair_offset + _distances(coords)[i, j])
+
+
+def same_geometry(a, b, tolerance=geometry_tolerance):
+    """
+    Check whether two structures, given as (species, coords), are the same
+    within a tolerance on their interatomic distances.
+    """
+    keys_a = geometry_descriptor(*a)
+    keys_b = geometry_descriptor(*b)
+    # distances of different pairs of elements differ by at least pair_offset
+    return (len(keys_a) == len(keys_b) and
+            np.abs(keys_a - keys_b).max(initial=0) <= tolerance)
+
+
+fingerprints = {'geometry': geometry_fingerprint, 'graph': graph_fingerprint}
+# how structures with the same fingerprint are compared, where the levels not
+# listed are equivalent whenever the fingerprints are the same
+comparisons = {'geometry': same_geometry}
+
+
+class Representatives(object):
+    """
+    The first structure seen of each equivalence class.
+
+    Args:
+        dedup (str): The level of equivalence, 'geometry' or 'graph'.
+        stored (dict): The representatives already in the store, as
+            {fingerprint: [index]}.
+        load (function): Get the (species, coords) of a stored representative
+            from its index, which is only needed for geometry.
+    """
+
+    def __init__(self, dedup, stored=None, load=None):
+        self.compare = comparisons.get(dedup)
+        self.candidates = dict((fp, list(indices))
+                               for fp, indices in (stored or {}).items())
+        self.load = load
+        # the structures of the representatives, as {index: (species,
+        # coords)}, loaded when first compared
+        self.structures = {}
+
+    def __len__(self):
+        return sum(len(indices) for indices in self.candidates.values())
+
+    def match(self, fingerprint, index, structure):
+        """
+        Find the representative of a structure, making it the representative
+        of a new class if it isn't equivalent to any of them.
+
+        Args:
+            fingerprint (str): The fingerprint of the structure.
+            index (int): Its index, which should be higher than those of all
+                the representatives.
+            structure (tuple): Its (species, coords).
+
+        Returns:
+            (int): The index of the representative, which is index if the
+            structure is the first of its class.
+        """
+        candidates = self.candidates.setdefault(fingerprint, [])
+        if self.compare is None:
+            if candidates:
+                return candidates[0]
+        else:
+            for rep in candidates:
+                if rep not in self.structures:
+                    self.structures[rep] = self.load(rep)
+                if self.compare(self.structures[rep], structure):
+                    return rep
+            self.structures[index] = (structure[0], np.asarray(structure[1]))
+        candidates.append(index)
+        return index
@@ -4,143 +4,336 @@ from __future__ import unicode_literals
 
 import os
 import sys
-import tarfile
-import shutil
-import tempfile
-
-from contextlib import contextmanager
-from pymatgen.io.gaussian import GaussianInput, GaussianOutput
+import json
+import time
+import argparse
+import traceback
+import multiprocessing
 
 from tinydb import TinyDB
 
+from store import StructureStore
+from extraction_cache import ExtractionCache, archive_key
+from results import save_results
+from ledger import Ledger
+from metrics import Overheads
+from archives import (archive_title, find_archive, is_within_directory,
+                      open_archive, suffixes)
+from log_archive import LogArchive
+from nics_probes import legacy_mapping, probe_file, ring_shieldings
+from gaussian_parser import (properly_terminated, read_excitation_energies,
+                             read_magnetic_shielding)
+
+
+# the only files needed from each archive, the mapping of the NICS probes to
+# their rings being missing from the archives of older calculations
+log_names = ('td.log', 'tda.log', 'nics_singlet.log', 'nics_triplet.log',
+             probe_file)
+
+# the NICS averaged over the probes of each ring size and side
+nics_keys = ('six_ring_above', 'six_ring_below', 'five_ring_above',
+             'five_ring_below')
 
-@contextmanager
-def cd(run_path, cleanup=lambda: True):
+# bump this whenever the extracted data changes, so cached results are redone
+parser_version = 1
+
+
+def read_logs(tar_file, names=log_names):
     """
-    Temporarily work in another directory, creating it if necessary.
+    Read log files out of a calculation archive without unpacking it.
+
+    The members are streamed out of the archive one at a time, stopping as soon
+    as all the requested logs have been found, and only those are read.
+
+    Args:
+        tar_file (str): Path to the <title>.tar.gz (or .tar.zst) archive,
+            which contains a <title> folder with the log files.
+        names (tuple): The names of the log files to read.
+
+    Returns:
+        (dict): The contents of the log files as {name: bytes}.
     """
-    home = os.getcwd()
-    os.chdir(os.path.expanduser(run_path))
-    try:
-        yield
-    finally:
-        os.chdir(home)
-        cleanup()
+    folder = archive_title(tar_file)
+    wanted = dict((os.path.join(folder, name), name) for name in names)
+    logs = {}
+    with open_archive(tar_file) as tar:
+        for member in tar:
+            if not is_within_directory('.', member.name):
+                raise Exception("Attempted Path Traversal in Tar File")
+            name = wanted.get(os.path.normpath(member.name))
+            if name and member.isfile():
+                logs[name] = tar.extractfile(member).read()
+                if len(logs) == len(wanted):
+                    break
+    return logs
 
 
-@contextmanager
-def tempdir():
+# the log archive opened by each worker process, as {filename: archive}
+_log_archives = {}
+
+
+def read_archived_logs(archive_file, title, names=log_names):
     """
-    Temporarily work in temporary directory, deleting it aftewards.
+    Read log files out of the single archive of all the calculations (see
+    log_archive), in the same form as read_logs.
     """
-    dirpath = tempfile.mkdtemp()
-    def cleanup():
-        shutil.rmtree(dirpath)
-    with cd(dirpath, cleanup):
-        yield dirpath
+    if archive_file not in _log_archives:
+        _log_archives[archive_file] = LogArchive(archive_file, readonly=True)
+    return _log_archives[archive_file].read_logs(title, names)
 
 
 def extract_data_from_tar_file(tar_file):
-    with tarfile.open(tar_file, 'r:gz') as tar:
-        def is_within_directory(directory, target):
-            
-            abs_directory = os.path.abspath(directory)
-            abs_target = os.path.abspath(target)
-        
-            prefix = os.path.commonprefix([abs_directory, abs_target])
-            
-            return prefix == abs_directory
-        
-        def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-        
-            for member in tar.getmembers():
-                member_path = os.path.join(path, member.name)
-                if not is_within_directory(path, member_path):
-                    raise Exception("Attempted Path Traversal in Tar File")
-        
-            tar.extractall(path, members, numeric_owner=numeric_owner) 
-            
-        
-        safe_extract(tar)
-
-    folder = tar_file.replace('.tar.gz', '')
-    with cd(folder):
-        tdout = GaussianOutput('td.log')
-        td_exit = tdout.read_excitation_energies()
-        td_triplet = [e for e in td_exit if 'triplet' in e[3].lower()][0][0]
-        td_singlet = [e for e in td_exit if 'singlet' in e[3].lower()][0][0]
-
-        tdaout = GaussianOutput('tda.log')
-        tda_exit = tdaout.read_excitation_energies()
-        tda_triplet = [e for e in tda_exit if 'triplet' in e[3].lower()][0][0]
-        tda_singlet = [e for e in tda_exit if 'singlet' in e[3].lower()][0][0]
-
-        nicssout = GaussianOutput('nics_singlet.log')
-        # occasionally some jobs fail here
-        if not nicssout.properly_terminated:
-            return False
-        nicss_mag = nicssout.read_magnetic_shielding()
-        nicss_six_ring_above = (abs(nicss_mag[-8]['isotropic']) +
-                                abs(nicss_mag[-6]['isotropic']))/2
-        nicss_six_ring_below = (abs(nicss_mag[-7]['isotropic']) +
-                                abs(nicss_mag[-5]['isotropic']))/2
-        nicss_five_ring_above = (abs(nicss_mag[-4]['isotropic']) +
-                                 abs(nicss_mag[-2]['isotropic']))/2
-        nicss_five_ring_below = (abs(nicss_mag[-3]['isotropic']) +
-                                 abs(nicss_mag[-1]['isotropic']))/2
-
-        nicstout = GaussianOutput('nics_triplet.log')
-        if not nicstout.properly_terminated:
-            return False
-        nicst_mag = nicstout.read_magnetic_shielding()
-        nicst_six_ring_above = (abs(nicst_mag[-8]['isotropic']) +
-                                abs(nicst_mag[-6]['isotropic']))/2
-        nicst_six_ring_below = (abs(nicst_mag[-7]['isotropic']) +
-                                abs(nicst_mag[-5]['isotropic']))/2
-        nicst_five_ring_above = (abs(nicst_mag[-4]['isotropic']) +
-                                 abs(nicst_mag[-2]['isotropic']))/2
-        nicst_five_ring_below = (abs(nicst_mag[-3]['isotropic']) +
-                                 abs(nicst_mag[-1]['isotropic']))/2
-
-        data = {'td_singlet': td_singlet, 'td_triplet': td_triplet,
-                'tda_singlet': tda_singlet, 'tda_triplet': tda_triplet,
-                'nicss_six_ring_above': nicss_six_ring_above,
-                'nicss_six_ring_below': nicss_six_ring_below,
-                'nicss_five_ring_above': nicss_five_ring_above,
-                'nicss_five_ring_below': nicss_five_ring_below,
-                'nicst_six_ring_above': nicst_six_ring_above,
-                'nicst_six_ring_below': nicst_six_ring_below,
-                'nicst_five_ring_above': nicst_five_ring_above,
-                'nicst_five_ring_below': nicst_five_ring_below}
+    return extract_data(read_logs(tar_file))
+
+
+def extract_data(logs):
+    """
+    Extract the properties from the logs given by read_logs.
+    """
+    td_exit = read_excitation_energies(logs['td.log'])
+    td_triplet = [e for e in td_exit if 'triplet' in e[3].lower()][0][0]
+    td_singlet = [e for e in td_exit if 'singlet' in e[3].lower()][0][0]
+
+    tda_exit = read_excitation_energies(logs['tda.log'])
+    tda_triplet = [e for e in tda_exit if 'triplet' in e[3].lower()][0][0]
+    tda_singlet = [e for e in tda_exit if 'singlet' in e[3].lower()][0][0]
+
+    if probe_file in logs:
+        mapping = json.loads(logs[probe_file].decode())
+    else:
+        mapping = legacy_mapping
+
+    # occasionally some jobs fail here
+    if not properly_terminated(logs['nics_singlet.log']):
+        return False
+    nicss = ring_shieldings(read_magnetic_shielding(logs['nics_singlet.log']),
+                            mapping)
+
+    if not properly_terminated(logs['nics_triplet.log']):
+        return False
+    nicst = ring_shieldings(read_magnetic_shielding(logs['nics_triplet.log']),
+                            mapping)
+
+    data = {'td_singlet': td_singlet, 'td_triplet': td_triplet,
+            'tda_singlet': tda_singlet, 'tda_triplet': tda_triplet}
+    for key in nics_keys:
+        data['nicss_' + key] = nicss.get(key)
+        data['nicst_' + key] = nicst.get(key)
     return data
 
 
-data_to_write = []
-db = TinyDB(os.path.join('..', 'data', 'structures.json'))
-systems = list(db.all())
-done = 0
-for i, system in enumerate(systems):
-    input_file = GaussianInput.from_dict(system['input'])
-    directory = input_file.title
-    tar_name = '{}.tar.gz'.format(directory)
-    tar_file = os.path.abspath(os.path.join('..', 'data', 'calculations', tar_name))
-    if os.path.isfile(tar_file):
-        # extract the data in a temp directory to avoid clobbering any data
-        with tempdir() as tmp_dir:
-            shutil.copy(tar_file, tmp_dir)
-            data = extract_data_from_tar_file(tar_name)
-            if not data:
-                print('{} did not finish correctly, skipping'.format(directory))
-                continue
-            data.update({'x_sub': system['x_sub'], 'y_sub': system['y_sub'],
-                         'z_sub': system['z_sub'], 'nx': system['nx'],
-                         'ny': system['ny'], 'title': system['title']})
-            data_to_write.append(data)
-
-    if i % 500 == 0:
-        done += 5
-        print('{}% completed'.format(done))
-
-print('writing data')
-db = TinyDB(os.path.join('..', 'data', 'calculated-data.json'))
-db.insert_multiple(data_to_write)
+def _extract(job):
+    """
+    Extract the data for one (index, title, tar_file) job in a worker, where
+    tar_file is either the archive of the compound or the log archive.
+
+    Any error is caught and returned, so that one bad archive doesn't take down
+    the whole pool. The time taken to read and parse the logs is returned too.
+    """
+    index, title, tar_file = job
+    seconds = {}
+    try:
+        start = time.time()
+        if tar_file.endswith(tuple(suffixes.values())):
+            logs = read_logs(tar_file)
+        else:
+            logs = read_archived_logs(tar_file, title)
+        seconds['extract_read'] = time.time() - start
+        start = time.time()
+        data = extract_data(logs)
+        seconds['extract_parse'] = time.time() - start
+        return index, data, None, seconds
+    except Exception:
+        return index, None, traceback.format_exc(), seconds
+
+
+def extract_all(jobs, workers=1, ordered=True):
+    """
+    Extract the data for a list of (index, title, tar_file) jobs.
+
+    Args:
+        jobs (list): The jobs to run.
+        workers (int): The number of worker processes.
+        ordered (bool): Whether the results are yielded in the same order as
+            the jobs, or as soon as they are finished.
+
+    Yields:
+        (index, data, error, seconds) tuples, where data is False if the
+        calculation did not finish correctly, error is the traceback of any
+        exception and seconds the time taken as {step: seconds}.
+    """
+    if workers == 1:
+        for result in map(_extract, jobs):
+            yield result
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        imap = pool.imap if ordered else pool.imap_unordered
+        for result in imap(_extract, jobs, chunksize=4):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Extract the calculated properties from the archives.')
+    parser.add_argument('-n', '--workers', type=int, default=1,
+                        help='number of worker processes (default: 1)')
+    parser.add_argument('--unordered', action='store_true',
+                        help='handle results as soon as they are finished')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only extract new or changed archives')
+    parser.add_argument('--hash', action='store_true',
+                        help='detect changed archives by hashing their '
+                             'contents rather than by size and mtime')
+    parser.add_argument('--archive',
+                        default=os.path.join('..', 'data',
+                                             'calculations.pack'),
+                        help='single archive of the calculations, read for '
+                             'the compounds in it instead of their own '
+                             'archives (see pack-archives.py)')
+    parser.add_argument('--columnar', action='store_true',
+                        help='also write the results as a NumPy structured '
+                             'array for analysis, to '
+                             'calculated-data-columnar.npy (see results.py)')
+    args = parser.parse_args()
+
+    # the python side of the extraction, recorded in the ledger
+    overheads = Overheads()
+    archive_overheads = []
+
+    with overheads.timed('extract_db'):
+        with StructureStore(os.path.join('..', 'data', 'structures.db'),
+                            readonly=True) as db:
+            systems = list(db.all())
+
+    archive = None
+    packed = set()
+    if os.path.isfile(args.archive + '.idx'):
+        with overheads.timed('extract_db'):
+            archive = LogArchive(args.archive, readonly=True)
+            packed = archive.titles()
+    archive_file = os.path.abspath(args.archive)
+
+    jobs = []
+    for system in systems:
+        # equivalent structures aren't calculated, their results are copied
+        # from the representative below
+        if system.get('alias_of'):
+            continue
+        if system['title'] in packed:
+            jobs.append((system['index'], system['title'], archive_file))
+            continue
+        tar_file = find_archive(os.path.join('..', 'data', 'calculations'),
+                                system['title'])
+        if tar_file:
+            jobs.append((system['index'], system['title'],
+                         os.path.abspath(tar_file)))
+
+    extracted = {}
+    titles = dict((index, title) for index, title, _ in jobs)
+
+    cache = None
+    if args.incremental:
+        cache = ExtractionCache(os.path.join('..', 'data',
+                                             'extraction-cache.db'),
+                                parser_version)
+        keys = {}
+        todo = []
+        with overheads.timed('extract_db'):
+            for job in jobs:
+                index, title, tar_file = job
+                if tar_file == archive_file:
+                    keys[index] = archive.key(title)
+                else:
+                    keys[index] = archive_key(tar_file,
+                                              content_hash=args.hash)
+                data = cache.get(title, keys[index])
+                if data is None:
+                    todo.append(job)
+                elif data:
+                    extracted[index] = data
+        print('{} of {} archives are new or changed'.format(len(todo),
+                                                            len(jobs)))
+        jobs = todo
+
+    done = 0
+    to_cache = []
+    for i, (index, data, error, seconds) in enumerate(
+            extract_all(jobs, workers=args.workers,
+                        ordered=not args.unordered)):
+        archive_overheads.extend((index, name, value)
+                                 for name, value in seconds.items())
+        if error:
+            print('{} failed with error:\n{}'.format(titles[index], error))
+        elif not data:
+            print('{} did not finish correctly, skipping'.format(
+                  titles[index]))
+        else:
+            extracted[index] = data
+
+        # errors aren't cached so that they're retried next time
+        if cache and not error:
+            to_cache.append((titles[index], keys[index], data))
+            if len(to_cache) >= 100:
+                with overheads.timed('extract_db'):
+                    cache.put_multiple(to_cache)
+                to_cache = []
+
+        if (i + 1) * 20 // len(jobs) > done:
+            done = (i + 1) * 20 // len(jobs)
+            print('{}% completed'.format(done * 5))
+
+    if cache:
+        with overheads.timed('extract_db'):
+            cache.put_multiple(to_cache)
+        cache.close()
+    if archive:
+        archive.close()
+
+    data_to_write = []
+    for system in systems:
+        rep = system.get('alias_of') or system['index']
+        if rep not in extracted:
+            continue
+        data = dict(extracted[rep])
+        if system.get('alias_of'):
+            data['alias_of'] = rep
+        data.update({'x_sub': system['x_sub'], 'y_sub': system['y_sub'],
+                     'z_sub': system['z_sub'], 'nx': system['nx'],
+                     'ny': system['ny'], 'title': system['title']})
+        data_to_write.append(data)
+
+    # write the complete set of results to a new file and swap it in, so that
+    # reruns replace rather than duplicate the rows and readers never see a
+    # partly written file
+    print('writing data')
+    with overheads.timed('extract_write'):
+        data_file = os.path.join('..', 'data', 'calculated-data.json')
+        tmp_file = data_file + '.tmp'
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        db = TinyDB(tmp_file)
+        db.insert_multiple(data_to_write)
+        db.close()
+        os.rename(tmp_file, data_file)
+
+        if args.columnar:
+            # not calculated-data, as its .json would replace the results
+            save_results(data_to_write, os.path.join(
+                '..', 'data', 'calculated-data-columnar'))
+
+    # only kept if the calculations were run with a ledger
+    ledger_file = os.path.join('..', 'data', 'ledger.db')
+    if os.path.isfile(ledger_file):
+        with Ledger(ledger_file) as ledger:
+            ledger.add_overheads(archive_overheads +
+                                 [(None, name, value) for name, value in
+                                  overheads.seconds.items()])
+
+
+if __name__ == '__main__':
+    main()
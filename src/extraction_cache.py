@@ -0,0 +1,94 @@
+"""
+Cache of the data extracted from each calculation archive.
+
+Each entry is keyed on the archive title, along with a key describing the
+archive contents (its size and modification time, or a hash of its contents)
+and the version of the parser that produced it. An entry is only used if both
+still match, so new or rerun calculations, and changes to the parsing, are
+picked up on the next extraction.
+"""
+
+import os
+import json
+import hashlib
+import sqlite3
+
+_schema = """
+CREATE TABLE IF NOT EXISTS results (
+    title TEXT PRIMARY KEY,
+    archive_key TEXT NOT NULL,
+    parser_version TEXT NOT NULL,
+    data TEXT NOT NULL
+)
+"""
+
+
+def archive_key(filename, content_hash=False):
+    """
+    Get a key that changes whenever the archive does.
+
+    Args:
+        filename (str): Path to the archive.
+        content_hash (bool): Use a hash of the contents rather than the size
+            and modification time, e.g. if the mtimes aren't reliable.
+    """
+    if content_hash:
+        sha1 = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        return 'sha1:' + sha1.hexdigest()
+    stat = os.stat(filename)
+    return 'stat:{}:{}'.format(stat.st_size, stat.st_mtime_ns)
+
+
+class ExtractionCache(object):
+    """
+    SQLite backed cache of extracted data.
+
+    Args:
+        filename (str): Path to the cache database.
+        parser_version (str): Entries written by any other version are
+            treated as missing.
+    """
+
+    def __init__(self, filename, parser_version, timeout=60):
+        self.filename = filename
+        self.parser_version = str(parser_version)
+        self.conn = sqlite3.connect(filename, timeout=timeout)
+        self.conn.execute(_schema)
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def get(self, title, key):
+        """
+        Get the cached data for an archive.
+
+        Returns:
+            The data (which is False if the calculation didn't finish
+            correctly), or None if there is no up to date entry.
+        """
+        row = self.conn.execute(
+            'SELECT data FROM results WHERE title = ? AND archive_key = ? '
+            'AND parser_version = ?',
+            (title, key, self.parser_version)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_multiple(self, entries):
+        """
+        Insert or replace an iterable of (title, key, data) entries.
+        """
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO results '
+                '(title, archive_key, parser_version, data) VALUES (?, ?, ?, ?)',
+                ((title, key, self.parser_version, json.dumps(data))
+                 for title, key, data in entries))
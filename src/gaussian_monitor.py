@@ -0,0 +1,272 @@
+"""
+Run g09 while watching its log, stopping runs that are going nowhere.
+
+A relaxation whose SCF doesn't converge, or whose optimisation oscillates
+between geometries, otherwise keeps going until it fails by itself or uses up
+the walltime of the job. GaussianRun reads the log as it is written and kills
+the run as soon as one of the rules is broken, noting the reason at the end of
+the log. The log is then not properly terminated, so the usual restart logic
+applies to it.
+
+The rules, where None turns a rule off, are:
+
+    max_scf_cycles: most SCF cycles in a single SCF
+    max_scf_failures: most SCFs that don't converge ("Convergence criterion
+        not met"), e.g. when Gaussian falls back to quadratic convergence
+    max_opt_steps: most optimisation steps
+    oscillation_steps, oscillation_tolerance: stop an optimisation that hasn't
+        found an energy more than the tolerance (Hartree) lower than its
+        previous best in this many steps, while the energy keeps going up and
+        down
+    stall_timeout: most seconds without anything written to the log, off by
+        default as a large job can go hours between writes without anything
+        being wrong
+"""
+
+import os
+import re
+import time
+import signal
+import subprocess
+
+default_rules = {'max_scf_cycles': 256,
+                 'max_scf_failures': 1,
+                 'max_opt_steps': None,
+                 'oscillation_steps': 20,
+                 'oscillation_tolerance': 1e-5,
+                 'stall_timeout': None}
+
+_cycle = re.compile(br'^\s*Cycle\s+(\d+)')
+_scf_done = re.compile(br'^\s*SCF Done:\s+E\(\S+\)\s*=\s*([-+]?\d+\.\d+)')
+_scf_failure = b'Convergence criterion not met'
+# printed once per optimisation step, with the convergence table
+_opt_step = re.compile(br'^\s*Maximum Force\s')
+
+
+class LogMonitor(object):
+    """
+    Incrementally read a log, checking it against the rules.
+
+    Args:
+        filename (str): The log being written.
+        rules (dict): Rules overriding the default_rules.
+    """
+
+    def __init__(self, filename, rules=None):
+        self.filename = filename
+        self.rules = dict(default_rules)
+        self.rules.update(rules or {})
+        self.last_change = time.time()
+        self._reset()
+
+    def _reset(self):
+        self.offset = 0
+        self.partial = b''
+        self.scf_failures = 0
+        self.energy = None
+        self.energies = []
+
+    def update(self):
+        """
+        Read whatever has been added to the log since the last update.
+
+        Returns:
+            (str): Why the run should be stopped, or None if it looks fine.
+        """
+        now = time.time()
+        try:
+            size = os.path.getsize(self.filename)
+        except OSError:
+            size = 0
+        if size < self.offset:
+            # the log was started again
+            self._reset()
+
+        if size == self.offset:
+            stall_timeout = self.rules['stall_timeout']
+            if stall_timeout is not None and \
+                    now - self.last_change > stall_timeout:
+                return 'nothing written to the log for {:.0f} s'.format(
+                    now - self.last_change)
+            return None
+
+        self.last_change = now
+        with open(self.filename, 'rb') as f:
+            f.seek(self.offset)
+            content = self.partial + f.read(size - self.offset)
+        self.offset = size
+        lines = content.split(b'\n')
+        # keep the last line until it's been written in full
+        self.partial = lines.pop()
+        for line in lines:
+            reason = self._check_line(line)
+            if reason:
+                return reason
+        return None
+
+    def _check_line(self, line):
+        rules = self.rules
+        match = _cycle.match(line)
+        if match:
+            cycles = int(match.group(1))
+            if rules['max_scf_cycles'] is not None and \
+                    cycles > rules['max_scf_cycles']:
+                return 'SCF not converged after {} cycles'.format(cycles - 1)
+            return None
+
+        match = _scf_done.match(line)
+        if match:
+            self.energy = float(match.group(1))
+            return None
+
+        if _scf_failure in line:
+            self.scf_failures += 1
+            if rules['max_scf_failures'] is not None and \
+                    self.scf_failures >= rules['max_scf_failures']:
+                return 'SCF not converged {} time(s)'.format(
+                    self.scf_failures)
+            return None
+
+        if _opt_step.match(line) and self.energy is not None:
+            self.energies.append(self.energy)
+            return self._check_optimisation()
+        return None
+
+    def _check_optimisation(self):
+        rules = self.rules
+        steps = len(self.energies)
+        if rules['max_opt_steps'] is not None and \
+                steps > rules['max_opt_steps']:
+            return 'optimisation not converged after {} steps'.format(
+                steps - 1)
+
+        window = rules['oscillation_steps']
+        if window is None or steps <= window:
+            return None
+        best = min(self.energies[:-window])
+        recent = self.energies[-window:]
+        if min(recent) < best - rules['oscillation_tolerance']:
+            return None
+        changes = [b - a for a, b in zip(recent[:-1], recent[1:])]
+        reversals = sum(1 for a, b in zip(changes[:-1], changes[1:])
+                        if a * b < 0)
+        if reversals >= window // 2:
+            return ('optimisation oscillating, no lower energy in the last {} '
+                    'steps'.format(window))
+        return None
+
+
+class GaussianRun(object):
+    """
+    A g09 run of <name>.com, writing <name>.log, that is stopped early if the
+    log breaks the rules.
+
+    Args:
+        name (str): The name of the input, without the extension.
+        rules (dict): Rules overriding the default_rules, or None to use the
+            defaults. False turns the monitoring off.
+        poll_interval (float): Seconds between reading the log in wait.
+    """
+
+    def __init__(self, name, rules=None, poll_interval=5):
+        self.name = name
+        self.rules = rules
+        self.poll_interval = poll_interval
+        self.process = None
+        self.monitor = None
+        self.reason = None
+        self.started = None
+        self.finished = None
+        # the resources used by g09, once it has finished
+        self.rusage = None
+
+    def start(self):
+        # the log is overwritten anyway, and the monitor mustn't read the
+        # previous run's
+        if os.path.isfile('{}.log'.format(self.name)):
+            os.remove('{}.log'.format(self.name))
+        self.started = time.time()
+        # in its own session, so all of the g09 processes can be killed
+        self.process = subprocess.Popen(
+            'g09 < {0}.com > {0}.log'.format(self.name), shell=True,
+            start_new_session=True)
+        if self.rules is not False:
+            self.monitor = LogMonitor('{}.log'.format(self.name), self.rules)
+        return self
+
+    def poll(self):
+        """
+        Check on the run, stopping it if it breaks the rules.
+
+        Returns:
+            (int): The exit code, or None if the run is still going.
+        """
+        returncode = self._reap()
+        if returncode is None and self.monitor is not None:
+            reason = self.monitor.update()
+            if reason:
+                self.abort(reason)
+            returncode = self.process.returncode
+        if returncode is not None and self.finished is None:
+            self.finished = time.time()
+        return returncode
+
+    def abort(self, reason):
+        """
+        Stop the run and note the reason at the end of the log.
+        """
+        self.reason = reason
+        self.kill()
+        with open('{}.log'.format(self.name), 'a') as f:
+            f.write(' Run stopped by the monitor: {}\n'.format(reason))
+
+    def _reap(self, block=False):
+        """
+        Get the exit code of the run if it has finished, collecting the
+        resources used by it and the processes it waited for on the way.
+        """
+        if self.process.returncode is None:
+            try:
+                pid, status, rusage = os.wait4(self.process.pid,
+                                               0 if block else os.WNOHANG)
+            except ChildProcessError:
+                # already collected
+                return self.process.wait()
+            if pid:
+                self.process.returncode = os.waitstatus_to_exitcode(status)
+                self.rusage = rusage
+        return self.process.returncode
+
+    def kill(self, timeout=30):
+        if self._reap() is not None:
+            return
+        try:
+            os.killpg(self.process.pid, signal.SIGTERM)
+            deadline = time.time() + timeout
+            while self._reap() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if self.process.returncode is None:
+                os.killpg(self.process.pid, signal.SIGKILL)
+        except OSError:
+            # already gone
+            pass
+        self._reap(block=True)
+
+    def wait(self):
+        """
+        Wait for the run to finish.
+
+        Returns:
+            (str): Why the run was stopped, or None if it ran to the end.
+        """
+        # check often at first, so short runs aren't held up
+        interval = 0.05
+        try:
+            while self.poll() is None:
+                time.sleep(interval)
+                interval = min(2 * interval, self.poll_interval)
+        except BaseException:
+            # don't leave g09 running if we're stopped
+            self.kill()
+            raise
+        return self.reason
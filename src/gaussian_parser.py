@@ -0,0 +1,140 @@
+"""
+Fast parsers for the few quantities needed from the Gaussian logs.
+
+GaussianOutput parses every geometry, orbital and frequency block of a log,
+whereas extract-data.py only needs the excitation energies and the magnetic
+shielding tensors. These functions just search for the relevant blocks, and
+read the log from the end where the block is expected to be near the end.
+
+The logs can be given as bytes or as binary file objects, such as those given
+by tarfile.extractfile.
+"""
+
+import re
+
+_excitation_header = re.compile(
+    br'^\sExcitation energies and oscillator strengths:', re.M)
+_excited_state = re.compile(
+    br'^\sExcited State\s*\d+:\s+(\S+)\s+([-+]?\d+\.\d+) eV\s+'
+    br'([-+]?\d+\.\d+) nm\s+f=([-+]?\d+\.\d+)', re.M)
+
+_shielding_header = b'Magnetic shielding tensor (ppm):'
+_shielding = re.compile(
+    br'^\s*(\d+)\s+(\S+)\s+Isotropic\s*=\s*([-+]?\d+\.\d+)\s+'
+    br'Anisotropy\s*=\s*([-+]?\d+\.\d+)', re.M)
+
+_normal_termination = b'Normal termination'
+
+_duration = (br'\s+(\d+)\s+days\s+(\d+)\s+hours\s+(\d+)\s+minutes'
+             br'\s+(\d+\.?\d*)\s+seconds')
+_cpu_time = re.compile(br'^\s*Job cpu time:' + _duration, re.M)
+_elapsed_time = re.compile(br'^\s*Elapsed time:' + _duration, re.M)
+_scf_done = re.compile(
+    br'^\s*SCF Done:.*?after\s+(\d+)\s+cycles', re.M)
+_opt_step = re.compile(br'^\s*Maximum Force\s', re.M)
+_nprocs = re.compile(br'^\s*%nprocshared=(\d+)', re.M | re.I)
+_mem = re.compile(br'^\s*%mem=(\S+)', re.M | re.I)
+
+
+def _read(log):
+    if isinstance(log, bytes):
+        return log
+    log.seek(0)
+    return log.read()
+
+
+def _read_tail(log, marker, block_size=65536):
+    """
+    Get the log from the last occurrence of marker onwards.
+
+    File objects are read backwards in blocks of doubling size, so only as much
+    of the end of the file as needed is read.
+    """
+    if isinstance(log, bytes):
+        i = log.rfind(marker)
+        return log[i:] if i >= 0 else b''
+
+    log.seek(0, 2)
+    pos = log.tell()
+    tail = b''
+    while pos > 0:
+        step = min(block_size, pos)
+        pos -= step
+        log.seek(pos)
+        tail = log.read(step) + tail
+        i = tail.rfind(marker)
+        if i >= 0:
+            return tail[i:]
+        block_size *= 2
+    return b''
+
+
+def properly_terminated(log):
+    """
+    Check whether a log contains a normal termination message.
+    """
+    # the message is almost always at the very end, so check there first
+    return (bool(_read_tail(log, _normal_termination, block_size=4096)) or
+            _normal_termination in _read(log))
+
+
+def read_excitation_energies(log):
+    """
+    Read the excitation energies after a TD-DFT calculation.
+
+    As with GaussianOutput.read_excitation_energies, every excited state after
+    the first "Excitation energies and oscillator strengths" header is read.
+
+    Returns:
+        (list): A tuple for each transition as (energy (eV), lambda (nm),
+            oscillator strength, symmetry), where symmetry is e.g. "Singlet-A".
+    """
+    content = _read(log)
+    header = _excitation_header.search(content)
+    if not header:
+        return []
+    return [(float(e), float(nm), float(f), symmetry.decode())
+            for symmetry, e, nm, f in
+            _excited_state.findall(content, header.start())]
+
+
+def read_magnetic_shielding(log):
+    """
+    Read the last set of magnetic shielding tensors after an NMR calculation.
+
+    Returns:
+        (list): A dict for each atom, including the Bq dummy atoms, with the
+            'element', 'isotropic' and 'anisotropy' keys.
+    """
+    block = _read_tail(log, _shielding_header)
+    return [{'element': element.decode(), 'isotropic': float(iso),
+             'anisotropy': float(aniso)}
+            for _, element, iso, aniso in _shielding.findall(block)]
+
+
+def _seconds(durations):
+    return sum(int(d) * 86400 + int(h) * 3600 + int(m) * 60 + float(sec)
+               for d, h, m, sec in durations)
+
+
+def read_run_metrics(log):
+    """
+    Read the resources used by a run from its log.
+
+    Returns:
+        (dict): The 'cpu_time' and 'elapsed_time' reported by Gaussian in
+            seconds (summed over the steps of a --Link1-- job), the total
+            'scf_cycles' and number of 'scf' calculations, the number of
+            'opt_steps' and the 'nprocs' and 'mem' it was given (None where not
+            in the log).
+    """
+    content = _read(log)
+    cycles = [int(n) for n in _scf_done.findall(content)]
+    nprocs = _nprocs.search(content)
+    mem = _mem.search(content)
+    return {'cpu_time': _seconds(_cpu_time.findall(content)),
+            'elapsed_time': _seconds(_elapsed_time.findall(content)),
+            'scf_cycles': sum(cycles), 'scf': len(cycles),
+            'opt_steps': len(_opt_step.findall(content)),
+            'nprocs': int(nprocs.group(1)) if nprocs else None,
+            'mem': mem.group(1).decode() if mem else None}
@@ -2,14 +2,17 @@
 
 
 import os
-import copy
-import itertools
+import time
+import argparse
+import collections
+import multiprocessing
 
-from pymatgen import Composition
 from pymatgen.io.gaussian import GaussianInput
 from pymatgen.core.structure import Molecule
 
-from tinydb import TinyDB
+from store import StructureStore
+from substitution import Scaffold
+from equivalence import Representatives, fingerprints, geometry_tolerance
 
 
 # define the substituents
@@ -48,135 +51,178 @@ nx_sites_thiol = [(1, [16, 23], [27, 28]),
                   (4, [19, 20], [26, 29]),
                   [None]]
 
-# define the rings used to calculate NICS
-six_mem_a = [0, 1, 2, 3, 4, 5]
-six_mem_b = [1, 2, 6, 7, 9, 9]
-five_mem_a = [0, 1, 9, 13, 12]
-five_mem_b = [2, 3, 10, 11, 6]
-
-data_to_write = []
-index = 1
-
-
-def cache_input_file(ginp, index, nx=None, ny=None, x_sub=None, y_sub=None,
-                     z_sub=None, prefix='ciba'):
-    nx_str = nx if nx else ""
-    ny_str = ny if ny else ""
-    x_str = x_sub if x_sub else ""
-    y_str = y_sub if y_sub else ""
-    z_str = z_sub if z_sub else ""
-    ginp.title = '{}_nx-{}_ny-{}_x-{}_y-{}_z-{}'.format(prefix, nx_str, ny_str,
-                                                        x_str, y_str, z_str)
-    data_to_write.append({'input': ginp.as_dict(), 'nx': nx, 'ny': ny,
-                          'x_sub': x_sub, 'y_sub': y_sub, 'z_sub': z_sub,
-                          'title': ginp.title, 'index': index})
-
-
-############################################
-# generate substituted pyridine structures #
-############################################
-
-# need to consider that nx positions 2 and 3 are incompatible
-# with substitutional sites z and y, respectively and ny
-# position 3 is incompatible with substitional site x
-#
-# the other important note is that we need to substitute the atoms from the
-# highest site_id downwards, otherwise the order and index of the atoms will
-# change
-
-gin = GaussianInput.from_file(os.path.join('..', 'templates',
-                                           'input-template.com'))
-gin.route_parameters['integral'] = '(acc2e=12)'  # hack to get round pmg bug
-
-print "generating pyridine substituted structures..."
-for nx, ny, x_sub, y_sub, z_sub in itertools.product(nx_sites, ny_sites,
-                                                     subs, subs, subs):
-    mol = copy.deepcopy(gin)
-
-    # if there are any clashes then skip the structure
-    if ((x_sub[0] and ny[0] == 3) or (y_sub[0] and nx[0] == 3) or
-            (z_sub[0] and nx[0] == 2)):
-        continue
-
-    # make a list of the substitutions and sort from highest to lowest site_id
-    # this list includes the H atoms next to the N we introduce in to the rings
-    sub_list = []
-
-    # these substituions happen in place therefore don't care about order
-    if nx[0]:
-        mol.molecule[nx[1][0]]._species = Composition('N')
-        mol.molecule[nx[1][1]]._species = Composition('N')
-        sub_list += zip(nx[2], [None]*2)
-    if ny[0]:
-        mol.molecule[ny[1][0]]._species = Composition('N')
-        mol.molecule[ny[1][1]]._species = Composition('N')
-        sub_list += zip(ny[2], [None]*2)
-
-    if x_sub[0]:
-        sub_list += zip(sub_sites['x'], [x_sub[1]]*2)
-    if y_sub[0]:
-        sub_list += zip(sub_sites['y'], [y_sub[1]]*2)
-    if z_sub[0]:
-        sub_list += zip(sub_sites['z'], [z_sub[1]]*2)
-    sub_list = sorted(sub_list, reverse=True, key=lambda x: x[0])
-
-    # now we can make substitutions in correct order
-    for site, sub in sub_list:
-        if sub:
-            mol.molecule.substitute(site, sub)
-        else:
-            # hyrdogen atom to remove
-            mol.molecule.remove_sites([site])
-
-    cache_input_file(mol, index, nx=nx[0], ny=ny[0], x_sub=x_sub[0],
-                     y_sub=y_sub[0], z_sub=z_sub[0])
-    index += 1
-
-#############################################
-# generate substituted thiophene structures #
-#############################################
-
-# same as before, including substituent clashing and site_id ordering caveats
-# but don't have a ny nitrogen substituent this time
-
-gin = GaussianInput.from_file(os.path.join('..', 'templates',
-                                           'input-template-thiol.com'))
-gin.route_parameters['integral'] = '(acc2e=12)'  # hack to get round pmg bug
-
-print "generating thiophene substituted structures..."
-for nx, x_sub, y_sub, z_sub in itertools.product(nx_sites_thiol, subs, subs, subs):
-    mol = copy.deepcopy(gin)
-
-    # if there are any clashes then skip the structure
-    if ((y_sub[0] and nx[0] == 3) or (z_sub[0] and nx[0] == 2)):
-        continue
-
-    # make a list of the substitutions and sort from highest to lowest site_id
-    sub_list = []
-
-    if nx[0]:
-        mol.molecule[nx[1][0]]._species = Composition('N')
-        mol.molecule[nx[1][1]]._species = Composition('N')
-        sub_list += zip(nx[2], [None]*2)
-
-    if x_sub[0]:
-        sub_list += zip(sub_sites_thiol['x'], [x_sub[1]]*2)
-    if y_sub[0]:
-        sub_list += zip(sub_sites_thiol['y'], [y_sub[1]]*2)
-    if z_sub[0]:
-        sub_list += zip(sub_sites_thiol['z'], [z_sub[1]]*2)
-    sub_list = sorted(sub_list, reverse=True, key=lambda x: x[0])
-
-    for site, sub in sub_list:
-        if sub:
-            mol.molecule.substitute(site, sub)
-        else:
-            # hyrdogen atom to remove
-            mol.molecule.remove_sites([site])
-
-    cache_input_file(mol, index, nx=nx[0], x_sub=x_sub[0], y_sub=y_sub[0],
-                     z_sub=z_sub[0], prefix='ciba_thiol')
-    index += 1
-
-db = TinyDB(os.path.join('..', 'data', 'structures.json'))
-db.insert_multiple(data_to_write)
+
+def load_scaffolds():
+    """
+    Load the scaffold templates, in the order their structures are indexed.
+    """
+    ############################################
+    # generate substituted pyridine structures #
+    ############################################
+
+    # need to consider that nx positions 2 and 3 are incompatible
+    # with substitutional sites z and y, respectively and ny
+    # position 3 is incompatible with substitional site x. Scaffold works these
+    # clashes out from the overlap between the H atoms removed for the
+    # nitrogens and the substituent sites, and skips them before building
+    # anything.
+    gin = GaussianInput.from_file(os.path.join('..', 'templates',
+                                               'input-template.com'))
+    gin.route_parameters['integral'] = '(acc2e=12)'  # hack to get round pmg bug
+    pyridine = Scaffold(gin, nx_sites, ny_sites, sub_sites, subs,
+                        prefix='ciba')
+
+    #############################################
+    # generate substituted thiophene structures #
+    #############################################
+
+    # same as before, including substituent clashing caveats but don't have a
+    # ny nitrogen substituent this time
+    gin = GaussianInput.from_file(os.path.join('..', 'templates',
+                                               'input-template-thiol.com'))
+    gin.route_parameters['integral'] = '(acc2e=12)'  # hack to get round pmg bug
+    thiophene = Scaffold(gin, nx_sites_thiol, [[None]], sub_sites_thiol, subs,
+                         prefix='ciba_thiol')
+    return [pyridine, thiophene]
+
+
+def chunks(scaffolds, chunk_size):
+    """
+    Split the work up into (scaffold_id, start_index, combos) chunks.
+
+    The indexes are assigned in enumeration order, so they are the same however
+    the work is split up and whichever chunks have already been done.
+    """
+    index = 1
+    for i, scaffold in enumerate(scaffolds):
+        combos = scaffold.combinations()
+        print('{}: {} structures'.format(scaffold.prefix, len(combos)))
+        for start in range(0, len(combos), chunk_size):
+            yield i, index + start, combos[start:start + chunk_size]
+        index += len(combos)
+
+
+# each worker process loads its own copy of the scaffolds
+_scaffolds = None
+_fingerprint = None
+
+
+def _init_worker(dedup):
+    global _scaffolds, _fingerprint
+    _scaffolds = load_scaffolds()
+    _fingerprint = fingerprints.get(dedup)
+
+
+def _build_chunk(chunk):
+    scaffold_id, start_index, combos = chunk
+    return list(_scaffolds[scaffold_id].records(combos, start_index,
+                                                fingerprint=_fingerprint))
+
+
+def record_structure(record):
+    """
+    Get the (species, coords) of a structure record.
+    """
+    sites = record['input']['molecule']['sites']
+    return ([site['species'][0]['element'] for site in sites],
+            [site['xyz'] for site in sites])
+
+
+def generate(db_file, processes=None, chunk_size=500, dedup='geometry',
+             core_hours=288):
+    """
+    Generate the structures and stream them into the store chunk by chunk.
+
+    Each chunk is written in its own transaction, so if the run is interrupted
+    it can be restarted and will skip the chunks that have already been written.
+    At most a couple of chunks per process are in flight at once, which bounds
+    the memory use whatever the size of the library.
+
+    Unless dedup is 'none', each structure is fingerprinted (see
+    equivalence.py) and any structure equivalent to one with a lower index
+    gets that index as 'alias_of'. Only the representatives are calculated,
+    and their results are reused for the aliases when extracting the data.
+    """
+    processes = processes or multiprocessing.cpu_count()
+    scaffolds = load_scaffolds()
+    with StructureStore(db_file) as db:
+        done = db.indices()
+        if done:
+            print('resuming, {} structures already written'.format(len(done)))
+        # the chunks are written in index order, so the first structure seen
+        # of each equivalence class is always the one with the lowest index
+        representatives = Representatives(
+            dedup, db.representatives(),
+            load=lambda index: record_structure(db.get(index)))
+
+        todo = (chunk for chunk in chunks(scaffolds, chunk_size)
+                if not all(i in done for i in range(chunk[1],
+                                                     chunk[1] + len(chunk[2]))))
+
+        pool = multiprocessing.Pool(processes, initializer=_init_worker,
+                                    initargs=(dedup,))
+        pending = collections.deque()
+        written = 0
+        start_time = last_report = time.time()
+
+        def write(records):
+            records = [r for r in records if r['index'] not in done]
+            for r in records:
+                if 'fingerprint' in r:
+                    rep = representatives.match(r['fingerprint'], r['index'],
+                                                record_structure(r))
+                    r['alias_of'] = rep if rep != r['index'] else None
+            db.insert_multiple(records)
+            return len(records)
+
+        try:
+            for chunk in todo:
+                pending.append(pool.apply_async(_build_chunk, (chunk,)))
+                if len(pending) < 2 * processes:
+                    continue
+                written += write(pending.popleft().get())
+                if time.time() - last_report > 10:
+                    last_report = time.time()
+                    print('{} structures written ({:.0f} structures/s)'.format(
+                          written, written / (last_report - start_time)))
+            while pending:
+                written += write(pending.popleft().get())
+        finally:
+            pool.terminate()
+            pool.join()
+
+        elapsed = time.time() - start_time
+        print('{} structures written in {:.0f} s ({:.0f} structures/s)'.format(
+              written, elapsed, written / elapsed if elapsed else 0))
+
+        if dedup in fingerprints:
+            aliases = db.aliases()
+            print('{} of {} structures are {} equivalent to another, saving up '
+                  'to {:.0f} core-hours'.format(aliases, len(db), dedup,
+                                                aliases * core_hours))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate the substituted structures.')
+    parser.add_argument('--db', default=os.path.join('..', 'data',
+                                                     'structures.db'),
+                        help='structure store to write to')
+    parser.add_argument('-n', '--processes', type=int, default=None,
+                        help='number of processes (default: all cores)')
+    parser.add_argument('--chunk-size', type=int, default=500,
+                        help='structures written per transaction')
+    parser.add_argument('--dedup', default='geometry',
+                        choices=sorted(fingerprints) + ['none'],
+                        help='only calculate one structure per equivalence '
+                             'class: geometry compares the interatomic '
+                             'distances of structures with the same bond '
+                             'graph to within {} A, graph also merges '
+                             'conformers (default: geometry)'.format(
+                                 geometry_tolerance))
+    parser.add_argument('--core-hours', type=float, default=288,
+                        help='core-hours per compound used to report the '
+                             'saving (default: 24 cores for the 12 h h_rt)')
+    args = parser.parse_args()
+    generate(args.db, processes=args.processes, chunk_size=args.chunk_size,
+             dedup=args.dedup, core_hours=args.core_hours)
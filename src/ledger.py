@@ -0,0 +1,310 @@
+"""
+Ledger of the state of each compound in the calculations.
+
+calculate-properties.py records each compound as it moves through the states
+(queued, relax, td, tda, nics, then archived or error, or alias for those that
+aren't calculated) along with the start and end time of every g09 run. The
+number of compounds in each state, the failures by stage and the total time of
+each stage are kept up to date by triggers, so the status can be read without
+looking at every compound or archive, however large the campaign.
+"""
+
+import time
+import sqlite3
+
+states = ('queued', 'relax', 'td', 'tda', 'nics', 'archived', 'error', 'alias')
+running_states = ('relax', 'td', 'tda', 'nics')
+
+# the performance metrics kept for each g09 run, besides its start and end
+stage_metrics = (('cores', 'INTEGER'),      # %nprocshared of the run
+                 ('cpu_seconds', 'REAL'),   # user + system time of g09
+                 ('max_rss', 'REAL'),       # memory high-water (MB)
+                 ('g09_cpu_time', 'REAL'),  # cpu time reported in the log
+                 ('scf_cycles', 'INTEGER'),
+                 ('opt_steps', 'INTEGER'))
+
+_schema = """
+CREATE TABLE IF NOT EXISTS compounds (
+    idx INTEGER PRIMARY KEY,
+    title TEXT,
+    state TEXT NOT NULL,
+    failed_stage TEXT,
+    reason TEXT,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS compounds_state ON compounds (state, updated);
+
+CREATE TABLE IF NOT EXISTS stages (
+    id INTEGER PRIMARY KEY,
+    idx INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stages_idx ON stages (idx, stage);
+
+CREATE TABLE IF NOT EXISTS overheads (
+    id INTEGER PRIMARY KEY,
+    idx INTEGER,
+    name TEXT NOT NULL,
+    seconds REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS state_counts (
+    state TEXT PRIMARY KEY,
+    n INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS failure_counts (
+    stage TEXT PRIMARY KEY,
+    n INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stage_totals (
+    stage TEXT PRIMARY KEY,
+    n INTEGER NOT NULL,
+    seconds REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+
+CREATE TRIGGER IF NOT EXISTS compounds_insert AFTER INSERT ON compounds
+BEGIN
+    INSERT OR IGNORE INTO state_counts VALUES (NEW.state, 0);
+    UPDATE state_counts SET n = n + 1 WHERE state = NEW.state;
+    INSERT OR IGNORE INTO failure_counts
+        SELECT IFNULL(NEW.failed_stage, 'unknown'), 0
+        WHERE NEW.state = 'error';
+    UPDATE failure_counts SET n = n + 1
+        WHERE NEW.state = 'error' AND
+            stage = IFNULL(NEW.failed_stage, 'unknown');
+END;
+
+CREATE TRIGGER IF NOT EXISTS compounds_update AFTER UPDATE ON compounds
+WHEN OLD.state != NEW.state OR
+    OLD.failed_stage IS NOT NEW.failed_stage
+BEGIN
+    UPDATE state_counts SET n = n - 1 WHERE state = OLD.state;
+    INSERT OR IGNORE INTO state_counts VALUES (NEW.state, 0);
+    UPDATE state_counts SET n = n + 1 WHERE state = NEW.state;
+    UPDATE failure_counts SET n = n - 1
+        WHERE OLD.state = 'error' AND
+            stage = IFNULL(OLD.failed_stage, 'unknown');
+    INSERT OR IGNORE INTO failure_counts
+        SELECT IFNULL(NEW.failed_stage, 'unknown'), 0
+        WHERE NEW.state = 'error';
+    UPDATE failure_counts SET n = n + 1
+        WHERE NEW.state = 'error' AND
+            stage = IFNULL(NEW.failed_stage, 'unknown');
+END;
+
+CREATE TRIGGER IF NOT EXISTS stages_insert AFTER INSERT ON stages
+BEGIN
+    INSERT OR IGNORE INTO stage_totals VALUES (NEW.stage, 0, 0);
+    UPDATE stage_totals SET n = n + 1,
+        seconds = seconds + NEW.finished - NEW.started
+        WHERE stage = NEW.stage;
+END;
+"""
+
+
+class Ledger(object):
+    """
+    SQLite backed ledger of the compound states and stage timings.
+
+    Args:
+        filename (str): Path to the ledger database.
+        timeout (float): Seconds to wait for another process's lock.
+    """
+
+    def __init__(self, filename, timeout=60):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename, timeout=timeout)
+        self.conn.executescript(_schema)
+        # ledgers written before the metrics were added lack the columns
+        columns = [c[1] for c in
+                   self.conn.execute('PRAGMA table_info(stages)')]
+        for name, kind in stage_metrics:
+            if name not in columns:
+                self.conn.execute('ALTER TABLE stages ADD COLUMN {} {}'.format(
+                                  name, kind))
+        self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def queue(self, indices):
+        """
+        Add compounds as queued, ignoring any already in the ledger.
+        """
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO compounds (idx, state, updated) "
+                "VALUES (?, 'queued', ?)", ((index, now) for index in indices))
+
+    def transition(self, index, state, title=None, failed_stage=None,
+                   reason=None):
+        """
+        Record a compound moving to a new state.
+
+        Args:
+            failed_stage (str): The stage that failed, for the error state.
+            reason (str): Why it failed.
+        """
+        now = time.time()
+        with self.conn:
+            if state in running_states:
+                # the start of the campaign, for working out the rate
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO meta VALUES ('started', ?)", (now,))
+            cursor = self.conn.execute(
+                'UPDATE compounds SET state = ?, title = COALESCE(?, title), '
+                'failed_stage = ?, reason = ?, updated = ? WHERE idx = ?',
+                (state, title, failed_stage, reason, now, index))
+            if cursor.rowcount == 0:
+                self.conn.execute(
+                    'INSERT INTO compounds (idx, title, state, failed_stage, '
+                    'reason, updated) VALUES (?, ?, ?, ?, ?, ?)',
+                    (index, title, state, failed_stage, reason, now))
+
+    def add_stage(self, index, stage, started, finished, metrics=None):
+        """
+        Record the timings of a g09 run.
+
+        Args:
+            metrics (dict): Any of the stage_metrics of the run.
+        """
+        metrics = metrics or {}
+        names = [name for name, _ in stage_metrics]
+        with self.conn:
+            self.conn.execute(
+                'INSERT INTO stages (idx, stage, started, finished, {}) '
+                'VALUES (?, ?, ?, ?, {})'.format(
+                    ', '.join(names), ', '.join('?' * len(names))),
+                [index, stage, started, finished] +
+                [metrics.get(name) for name in names])
+
+    def add_overheads(self, rows):
+        """
+        Record the time spent in the Python side of the workflow, as an
+        iterable of (index, name, seconds), where index is None for time not
+        spent on a particular compound.
+        """
+        with self.conn:
+            self.conn.executemany(
+                'INSERT INTO overheads (idx, name, seconds) VALUES (?, ?, ?)',
+                rows)
+
+    def failed(self, limit=None):
+        """
+        Get the (index, title, failed stage, reason) of the compounds in the
+        error state, most recent first.
+        """
+        return self.conn.execute(
+            "SELECT idx, title, failed_stage, reason FROM compounds "
+            "WHERE state = 'error' ORDER BY updated DESC LIMIT ?",
+            (-1 if limit is None else limit,)).fetchall()
+
+    def runs(self):
+        """
+        Iterate over every g09 run recorded, as dicts of the compound 'index'
+        and 'title', the 'stage', its 'wall_time' in seconds and the
+        stage_metrics.
+        """
+        names = [name for name, _ in stage_metrics]
+        cursor = self.conn.execute(
+            'SELECT s.idx, c.title, s.stage, s.finished - s.started, {} '
+            'FROM stages s JOIN compounds c ON c.idx = s.idx'.format(
+                ', '.join('s.' + name for name in names)))
+        for row in cursor:
+            yield dict(zip(['index', 'title', 'stage', 'wall_time'] + names,
+                           row))
+
+    def overhead_totals(self):
+        """
+        Get the total time spent on each part of the Python side.
+
+        Returns:
+            (dict): The totals as {name: (compounds, seconds)}.
+        """
+        return dict((name, (n, seconds)) for name, n, seconds in
+                    self.conn.execute(
+                        'SELECT name, COUNT(DISTINCT idx), SUM(seconds) '
+                        'FROM overheads GROUP BY name'))
+
+    def entry(self, index, title=None):
+        """
+        Get the ledger entry of a single compound.
+        """
+        return LedgerEntry(self, index, title)
+
+    def status(self, total=None):
+        """
+        Summarise the campaign.
+
+        Args:
+            total (int): The number of compounds in the campaign, if more than
+                have been added to the ledger.
+
+        Returns:
+            (dict): The 'counts' of compounds in each state, the 'failures' by
+            stage, the mean 'stage_times' in seconds, the 'rate' of compounds
+            finished per hour and the 'eta' in seconds to finish the rest (None
+            when not known).
+        """
+        counts = dict((state, 0) for state in states)
+        counts.update(self.conn.execute('SELECT state, n FROM state_counts'))
+        failures = dict(self.conn.execute(
+            'SELECT stage, n FROM failure_counts WHERE n > 0'))
+        stage_times = dict(
+            (stage, seconds / n) for stage, n, seconds in
+            self.conn.execute('SELECT stage, n, seconds FROM stage_totals')
+            if n)
+
+        in_ledger = sum(counts.values())
+        if total is not None and total > in_ledger:
+            counts['queued'] += total - in_ledger
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'started'").fetchone()
+        done = counts['archived'] + counts['error']
+        remaining = sum(counts[state] for state in ('queued',) +
+                        running_states)
+        rate = eta = None
+        if row and done:
+            rate = done / max(time.time() - row[0], 1e-9)
+            eta = remaining / rate
+        return {'counts': counts, 'failures': failures,
+                'stage_times': stage_times,
+                'rate': rate * 3600 if rate else None, 'eta': eta}
+
+
+class LedgerEntry(object):
+    """
+    The ledger bound to one compound, as given by Ledger.entry.
+    """
+
+    def __init__(self, ledger, index, title=None):
+        self.ledger = ledger
+        self.index = index
+        self.title = title
+
+    def transition(self, state, failed_stage=None, reason=None):
+        self.ledger.transition(self.index, state, title=self.title,
+                               failed_stage=failed_stage, reason=reason)
+
+    def add_stage(self, stage, started, finished, metrics=None):
+        self.ledger.add_stage(self.index, stage, started, finished, metrics)
+
+    def add_overheads(self, seconds):
+        """
+        Record the overheads of the compound given as {name: seconds}.
+        """
+        self.ledger.add_overheads((self.index, name, value)
+                                  for name, value in seconds.items())
@@ -0,0 +1,260 @@
+"""
+Single append-only archive of the calculation files of every compound.
+
+Rather than a <title>.tar.gz per compound, the files are appended, each
+compressed on its own, to one data file, and a SQLite index alongside it
+(<archive>.idx) maps each title and file name to where its bytes are. A single
+log is read with one lookup and one read, without decompressing anything else,
+and the archive is a couple of files however many compounds there are.
+
+Each member in the data file is preceded by a header giving its title, name
+and compression, so the index can be rebuilt from the data file alone (see
+LogArchive.reindex). Members are only ever appended; adding a file again points
+the index at the new copy.
+"""
+
+import os
+import zlib
+import struct
+import sqlite3
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+_schema = """
+CREATE TABLE IF NOT EXISTS members (
+    title TEXT NOT NULL,
+    name TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    codec TEXT NOT NULL,
+    PRIMARY KEY (title, name)
+);
+CREATE TABLE IF NOT EXISTS tail (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    end_offset INTEGER NOT NULL
+);
+"""
+
+_magic = b'SFLA'
+# magic, title length, name length, data length, codec
+_header = struct.Struct('<4sHHQB')
+codecs = ('none', 'zlib', 'zstd')
+
+
+def compress(data, codec='zlib', level=6):
+    if codec == 'zlib':
+        return zlib.compress(data, level)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd compression needs the zstandard package')
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    if codec == 'none':
+        return data
+    raise ValueError('unknown compression: {}'.format(codec))
+
+
+def decompress(data, codec):
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd compression needs the zstandard package')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+class LogArchive(object):
+    """
+    Append-only archive of calculation files with an index of its members.
+
+    Appends are made in an immediate transaction on the index, so several
+    processes can add to the same archive.
+
+    Args:
+        filename (str): Path to the data file; the index is <filename>.idx.
+        readonly (bool): Open the archive for reading only.
+        timeout (float): Seconds to wait for another process's lock.
+    """
+
+    def __init__(self, filename, readonly=False, timeout=60):
+        self.filename = filename
+        index_file = filename + '.idx'
+        if readonly:
+            self.conn = sqlite3.connect('file:{}?mode=ro'.format(index_file),
+                                        uri=True, timeout=timeout)
+        else:
+            # autocommit mode, so the transactions can be started explicitly
+            self.conn = sqlite3.connect(index_file, timeout=timeout,
+                                        isolation_level=None)
+            self.conn.executescript(_schema)
+            if not os.path.exists(filename):
+                open(filename, 'ab').close()
+        self.fd = os.open(filename, os.O_RDONLY)
+        if not readonly and self._end() is None and \
+                os.fstat(self.fd).st_size:
+            # the index has been lost
+            self.reindex()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, title):
+        row = self.conn.execute('SELECT 1 FROM members WHERE title = ?',
+                                (title,)).fetchone()
+        return row is not None
+
+    def close(self):
+        os.close(self.fd)
+        self.conn.close()
+
+    def _end(self):
+        """
+        Get the end of the last complete member, or None for a new index.
+        """
+        row = self.conn.execute('SELECT end_offset FROM tail').fetchone()
+        return row[0] if row else None
+
+    def _set_end(self, offset):
+        self.conn.execute('INSERT OR REPLACE INTO tail VALUES (0, ?)',
+                          (offset,))
+
+    def add(self, title, members, codec='zlib', level=6):
+        """
+        Append the files of a compound.
+
+        Args:
+            title (str): The title of the compound.
+            members (dict): The contents of the files as {name: bytes}.
+            codec (str): How each file is compressed, one of codecs.
+        """
+        chunks = []
+        for name, data in sorted(members.items()):
+            packed = compress(data, codec, level)
+            title_bytes = title.encode('utf-8')
+            name_bytes = name.encode('utf-8')
+            prefix = _header.pack(_magic, len(title_bytes), len(name_bytes),
+                                  len(packed), codecs.index(codec)) + \
+                title_bytes + name_bytes
+            chunks.append((name, len(data), prefix, packed))
+
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = []
+            offset = self._end() or 0
+            with open(self.filename, 'r+b') as f:
+                # drop anything left by an append that was interrupted
+                f.truncate(offset)
+                f.seek(offset)
+                for name, size, prefix, packed in chunks:
+                    f.write(prefix)
+                    f.write(packed)
+                    rows.append((title, name, offset + len(prefix),
+                                 len(packed), size, codec))
+                    offset += len(prefix) + len(packed)
+                f.flush()
+                os.fsync(f.fileno())
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO members '
+                '(title, name, offset, length, size, codec) '
+                'VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self._set_end(offset)
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
+    def read(self, title, name):
+        """
+        Read a file of a compound, or None if it isn't in the archive.
+        """
+        row = self.conn.execute(
+            'SELECT offset, length, codec FROM members '
+            'WHERE title = ? AND name = ?', (title, name)).fetchone()
+        if row is None:
+            return None
+        offset, length, codec = row
+        return decompress(os.pread(self.fd, length, offset), codec)
+
+    def read_logs(self, title, names):
+        """
+        Read the files of a compound, as {name: bytes}, leaving out any that
+        aren't in the archive.
+        """
+        logs = {}
+        for name in names:
+            data = self.read(title, name)
+            if data is not None:
+                logs[name] = data
+        return logs
+
+    def titles(self):
+        """
+        Get the titles of all the compounds in the archive.
+        """
+        return set(row[0] for row in
+                   self.conn.execute('SELECT DISTINCT title FROM members'))
+
+    def members(self, title):
+        return [row[0] for row in self.conn.execute(
+            'SELECT name FROM members WHERE title = ? ORDER BY name',
+            (title,))]
+
+    def key(self, title):
+        """
+        Get a key that changes whenever the files of a compound are added
+        again, as the new copies are always further into the archive.
+        """
+        row = self.conn.execute('SELECT MAX(offset) FROM members '
+                                'WHERE title = ?', (title,)).fetchone()
+        return 'pack:{}'.format(row[0])
+
+    def reindex(self):
+        """
+        Rebuild the index from the headers in the data file, e.g. if it has
+        been lost. Anything after the last complete member, left by an append
+        that was interrupted, is ignored and overwritten by the next.
+
+        Returns:
+            (int): The number of members found.
+        """
+        rows = {}
+        size = os.fstat(self.fd).st_size
+        offset = 0
+        while offset + _header.size <= size:
+            magic, title_length, name_length, length, codec = \
+                _header.unpack(os.pread(self.fd, _header.size, offset))
+            if magic != _magic:
+                break
+            start = offset + _header.size
+            names = os.pread(self.fd, title_length + name_length, start)
+            data_offset = start + title_length + name_length
+            if data_offset + length > size:
+                break
+            title = names[:title_length].decode('utf-8')
+            name = names[title_length:].decode('utf-8')
+            data = decompress(os.pread(self.fd, length, data_offset),
+                              codecs[codec])
+            # later copies replace earlier ones
+            rows[title, name] = (title, name, data_offset, length, len(data),
+                                 codecs[codec])
+            offset = data_offset + length
+
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.conn.execute('DELETE FROM members')
+            self.conn.executemany(
+                'INSERT INTO members (title, name, offset, length, size, '
+                'codec) VALUES (?, ?, ?, ?, ?, ?)', rows.values())
+            self._set_end(offset)
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+        return len(rows)
@@ -0,0 +1,37 @@
+"""
+Timing of the Python side of the workflow.
+
+The g09 runs take most of the time, but reading logs, tarring and database
+access happen for every compound, so are worth keeping an eye on. Overheads
+adds up the time spent in each of these, e.g.:
+
+    overheads = Overheads()
+    with overheads.timed('tar'):
+        ...
+    overheads.seconds  # {'tar': 1.2}
+"""
+
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Overheads(object):
+    """
+    Total time spent in named sections of code.
+    """
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+
+    def reset(self):
+        self.seconds.clear()
+
+    @contextmanager
+    def timed(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.time() - start
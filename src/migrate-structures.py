@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+
+"""
+Convert an existing TinyDB structures.json file into an indexed structure store.
+
+usage: migrate-structures.py [structures.json] [structures.db]
+"""
+
+import os
+import sys
+import itertools
+
+from tinydb import TinyDB
+
+from store import StructureStore
+
+json_file = os.path.join('..', 'data', 'structures.json')
+db_file = os.path.join('..', 'data', 'structures.db')
+if len(sys.argv) > 1:
+    json_file = sys.argv[1]
+if len(sys.argv) > 2:
+    db_file = sys.argv[2]
+
+if os.path.exists(db_file):
+    sys.exit('{} already exists, refusing to overwrite it'.format(db_file))
+
+print('reading {}'.format(json_file))
+records = iter(TinyDB(json_file).all())
+
+with StructureStore(db_file) as store:
+    # insert in chunks so we don't hold a second copy of everything in memory
+    while True:
+        chunk = list(itertools.islice(records, 1000))
+        if not chunk:
+            break
+        store.insert_multiple(chunk)
+    print('wrote {} structures to {}'.format(len(store), db_file))
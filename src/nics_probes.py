@@ -0,0 +1,219 @@
+"""
+Placement of the Bq probes for the NICS(1) calculations.
+
+The rings are found from the bonds of each relaxed structure (see
+equivalence.bond_graph) rather than from fixed atom indexes, so the probes are
+right for any scaffold. Only the rings at the core of the fused ring system are
+probed (see core_rings), not the rings at its ends or those of any ring
+substituents, with the six membered rings first then the five membered ones,
+each in order of their lowest atom index.
+For the scaffolds in generate-structures.py these are the two six and two five
+membered rings that were always probed.
+
+A plane is fitted to each ring by SVD, with the rings of a whole batch of
+structures fitted at once, and a probe is put 1 A above and below the centre of
+the ring along its normal, where above is the side with positive z. The
+mapping from the probes to their rings is written next to the NICS inputs
+(probe_file), and extract-data.py uses it to average the shieldings of each
+ring, rather than relying on the probes being the last atoms of the input.
+"""
+
+import json
+
+import numpy as np
+
+from equivalence import bond_graph
+
+# the largest ring looked for
+max_ring_size = 8
+# the distance of the probes from the centre of the ring, NICS(1)
+probe_distance = 1.0
+
+probe_file = 'nics_probes.json'
+
+ring_names = {3: 'three', 4: 'four', 5: 'five', 6: 'six', 7: 'seven',
+              8: 'eight'}
+sides = ('above', 'below')
+
+# the probes of calculations made before the mapping was written: the last
+# eight atoms, above and below two six then two five membered rings
+legacy_mapping = {'rings': [[0, 1, 2, 3, 4, 5], [1, 2, 6, 7, 8, 9],
+                            [0, 1, 9, 13, 12], [2, 3, 10, 11, 6]],
+                  'probes': [{'index': i - 8, 'ring': i // 2,
+                              'side': sides[i % 2]} for i in range(8)]}
+
+
+def _shortest_path(neighbours, start, end, max_length):
+    """
+    Breadth first search for the shortest path from start to end that doesn't
+    use the bond between them.
+    """
+    previous = {start: None}
+    frontier = [start]
+    for _ in range(max_length):
+        following = []
+        for atom in frontier:
+            for other in neighbours[atom]:
+                if other in previous or (atom == start and other == end):
+                    continue
+                previous[other] = atom
+                if other == end:
+                    path = [end]
+                    while previous[path[-1]] is not None:
+                        path.append(previous[path[-1]])
+                    return path
+                following.append(other)
+        frontier = following
+    return None
+
+
+def find_rings(neighbours, max_size=max_ring_size):
+    """
+    Find the smallest ring through each bond, which for (fused) aromatic rings
+    are the rings themselves.
+
+    Returns:
+        (list): Each ring as a sorted list of atom indexes, in order of size
+        then lowest atom index.
+    """
+    rings = set()
+    for atom, bonded in enumerate(neighbours):
+        for other in bonded:
+            if other > atom:
+                path = _shortest_path(neighbours, atom, other, max_size - 1)
+                if path:
+                    rings.add(tuple(sorted(path)))
+    return [list(ring) for ring in sorted(rings, key=lambda r: (len(r), r))]
+
+
+def core_rings(rings):
+    """
+    Pick the rings at the core of the largest fused ring system, i.e. of rings
+    sharing a bond, leaving out the rings of the substituents and the rings at
+    the ends of the system, which are fused to only one other ring. If every
+    ring is at an end, e.g. in naphthalene, all the rings of the system are
+    picked.
+
+    Returns:
+        (list): The rings, largest first then in order of lowest atom index.
+    """
+    def fused(a, b):
+        return a is not b and len(set(a) & set(b)) > 1
+
+    systems = []
+    for ring in rings:
+        joined = [s for s in systems if any(fused(ring, r) for r in s)]
+        for system in joined:
+            systems.remove(system)
+        systems.append(sum(joined, []) + [ring])
+    if not systems:
+        return []
+    # the system with the lowest atom index wins ties
+    system = max(systems, key=lambda s: (len(s), -min(min(r) for r in s)))
+    core = [ring for ring in system
+            if sum(fused(ring, other) for other in system) > 1] or system
+    return sorted(core, key=lambda r: (-len(r), r))
+
+
+def fit_planes(points, counts):
+    """
+    Fit a plane to each of a batch of rings with a single SVD.
+
+    Args:
+        points (array): The coordinates of the atoms of each ring, with shape
+            (rings, largest ring size, 3), where the rows past the size of a
+            ring are ignored.
+        counts (array): The number of atoms in each ring.
+
+    Returns:
+        (tuple): Arrays of the centre and unit normal of each ring, with the
+        normals pointing towards positive z.
+    """
+    points = np.asarray(points, dtype=float)
+    counts = np.asarray(counts)
+    mask = np.arange(points.shape[1])[None] < counts[:, None]
+    centres = (points * mask[..., None]).sum(axis=1) / counts[:, None]
+    # padding rows are zero once centred, so they don't change the fit
+    centred = (points - centres[:, None]) * mask[..., None]
+    _, _, vt = np.linalg.svd(centred)
+    normals = vt[:, -1]
+    normals *= np.where(normals[:, 2] < 0, -1, 1)[:, None]
+    return centres, normals
+
+
+def place_probes(structures, distance=probe_distance):
+    """
+    Find the probes of a batch of structures.
+
+    Args:
+        structures (list): The structures as (species, coords), where species
+            are element symbols and coords are Cartesian in Angstrom, e.g. the
+            species and cart_coords of a pymatgen Molecule.
+        distance (float): The distance of the probes from the ring centres.
+
+    Returns:
+        (list): For each structure, a tuple of an array of the coordinates of
+        its probes, to be appended to the structure in order, and the mapping
+        of the probes to the rings as {'rings': [atom indexes],
+        'probes': [{'index', 'ring', 'side'}]}, where index is the position of
+        the probe in the structure with the probes appended.
+    """
+    rings = []
+    for species, coords in structures:
+        rings.append(core_rings(find_rings(bond_graph(species, coords))))
+
+    batch = [(i, ring) for i, structure_rings in enumerate(rings)
+             for ring in structure_rings]
+    size = max([len(ring) for _, ring in batch] or [0])
+    points = np.zeros((len(batch), size, 3))
+    for j, (i, ring) in enumerate(batch):
+        points[j, :len(ring)] = np.asarray(structures[i][1])[ring]
+    if batch:
+        centres, normals = fit_planes(points, [len(r) for _, r in batch])
+    else:
+        centres = normals = np.zeros((0, 3))
+
+    probes = []
+    j = 0
+    for (species, _), structure_rings in zip(structures, rings):
+        n = len(structure_rings)
+        coords = np.empty((2 * n, 3))
+        coords[0::2] = centres[j:j + n] + distance * normals[j:j + n]
+        coords[1::2] = centres[j:j + n] - distance * normals[j:j + n]
+        j += n
+        mapping = {'rings': [[int(a) for a in r] for r in structure_rings],
+                   'probes': [{'index': len(species) + k, 'ring': k // 2,
+                               'side': sides[k % 2]} for k in range(2 * n)]}
+        probes.append((coords, mapping))
+    return probes
+
+
+def write_mapping(mapping, filename=probe_file):
+    """
+    Write the mapping of the probes to the rings next to the NICS inputs.
+    """
+    with open(filename, 'w') as f:
+        json.dump(mapping, f, indent=1)
+
+
+def ring_shieldings(shielding, mapping):
+    """
+    Average the NICS of the rings of each size on each side.
+
+    Args:
+        shielding (list): The magnetic shielding of each atom, as given by
+            gaussian_parser.read_magnetic_shielding.
+        mapping (dict): The mapping of the probes to the rings, as given by
+            place_probes, or legacy_mapping for calculations made without one.
+
+    Returns:
+        (dict): The mean absolute isotropic shielding of the probes, as
+        {'<size>_ring_<side>': value}, e.g. 'six_ring_above'.
+    """
+    values = {}
+    for probe in mapping['probes']:
+        size = len(mapping['rings'][probe['ring']])
+        key = '{}_ring_{}'.format(ring_names.get(size, size), probe['side'])
+        values.setdefault(key, []).append(
+            abs(shielding[probe['index']]['isotropic']))
+    return dict((key, sum(v) / len(v)) for key, v in values.items())
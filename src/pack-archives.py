@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""
+Convert the per-compound archives of the calculations into a single archive.
+
+Every file of each finished <title>.tar.gz (or .tar.zst) archive is appended to
+the log archive (see log_archive), skipping compounds that are already in it,
+so the conversion can be rerun as more compounds finish. The archives of
+calculations that didn't finish are left alone, as they're needed to restart
+them. calculate-properties.py takes the compounds in the pack as finished, so
+their archives can be removed once they've been added (--remove).
+
+usage: pack-archives.py [--calculations ../data/calculations]
+                        [--archive ../data/calculations.pack]
+                        [--codec zlib] [--level 6] [--remove] [--reindex]
+"""
+
+import os
+import glob
+import argparse
+
+from archives import (archive_title, is_within_directory,
+                      open_archive, suffixes)
+from log_archive import LogArchive, codecs
+
+
+def read_members(tar_file):
+    """
+    Read all the files in an archive, as {name: bytes} with the names
+    relative to the <title> folder.
+    """
+    title = archive_title(tar_file)
+    members = {}
+    with open_archive(tar_file) as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            if not is_within_directory(title, member.name):
+                raise Exception("Attempted Path Traversal in Tar File")
+            name = os.path.relpath(os.path.normpath(member.name), title)
+            members[name] = tar.extractfile(member).read()
+    return members
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--calculations',
+                        default=os.path.join('..', 'data', 'calculations'))
+    parser.add_argument('--archive',
+                        default=os.path.join('..', 'data',
+                                             'calculations.pack'))
+    parser.add_argument('--codec', choices=codecs, default='zlib',
+                        help='compression of each file (default: zlib)')
+    parser.add_argument('--level', type=int, default=6,
+                        help='compression level (default: 6)')
+    parser.add_argument('--remove', action='store_true',
+                        help='remove each archive once it has been added')
+    parser.add_argument('--reindex', action='store_true',
+                        help='rebuild the index of the archive from its data '
+                             'file and stop')
+    args = parser.parse_args()
+
+    with LogArchive(args.archive) as archive:
+        if args.reindex:
+            print('indexed {} files'.format(archive.reindex()))
+            return
+
+        tar_files = sorted(
+            filename for suffix in suffixes.values() for filename in
+            glob.glob(os.path.join(args.calculations, '*' + suffix))
+            if not filename.endswith('_error' + suffix))
+        done = archive.titles()
+        added = 0
+        for i, tar_file in enumerate(tar_files):
+            title = archive_title(tar_file)
+            if title not in done:
+                archive.add(title, read_members(tar_file), args.codec,
+                            args.level)
+                added += 1
+            if args.remove:
+                os.remove(tar_file)
+            if (i + 1) % 1000 == 0:
+                print('{} of {} archives done'.format(i + 1, len(tar_files)))
+        print('added {} compounds to {}, {} were already in it'.format(
+              added, args.archive, len(tar_files) - added))
+
+
+if __name__ == '__main__':
+    main()
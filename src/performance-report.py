@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""
+Report where the core-hours of the calculations go, from the ledger.
+
+The core-hours of each g09 run are its wall time times the cores it was given,
+and are broken down by stage, by scaffold and by the substituent at each
+position, alongside the CPU efficiency (the CPU time used per core-hour), SCF
+cycles, optimisation steps and memory high-water of the runs, and the time
+spent on the Python side (parsing, tarring and database access).
+
+usage: performance-report.py [--ledger ../data/ledger.db] [--json]
+"""
+
+import json
+import argparse
+
+from collections import defaultdict
+
+from ledger import Ledger
+from results import category_columns, title_labels
+
+
+def summarise(runs):
+    """
+    Add up a group of runs.
+    """
+    compounds = max(len(set(run['index'] for run in runs)), 1)
+    core_hours = sum(run['wall_time'] * (run['cores'] or 1)
+                     for run in runs) / 3600
+    # the cpu time is missing for runs that were killed
+    measured = [run for run in runs if run['cpu_seconds'] is not None]
+    measured_core_hours = sum(run['wall_time'] * (run['cores'] or 1)
+                              for run in measured) / 3600
+    cpu_hours = sum(run['cpu_seconds'] for run in measured) / 3600
+    max_rss = [run['max_rss'] for run in runs if run['max_rss'] is not None]
+    return {
+        'runs': len(runs),
+        'compounds': len(set(run['index'] for run in runs)),
+        'core_hours': core_hours,
+        'core_hours_per_compound': core_hours / compounds,
+        'mean_wall_time': sum(run['wall_time'] for run in runs) /
+        max(len(runs), 1),
+        'cpu_efficiency': (cpu_hours / measured_core_hours
+                           if measured_core_hours else None),
+        'scf_cycles_per_compound': sum(run['scf_cycles'] or 0
+                                       for run in runs) / compounds,
+        'opt_steps_per_compound': sum(run['opt_steps'] or 0
+                                      for run in runs) / compounds,
+        'max_rss': max(max_rss) if max_rss else None}
+
+
+def group_by(runs, key):
+    groups = defaultdict(list)
+    for run in runs:
+        groups[key(run)].append(run)
+    return dict((name, summarise(group)) for name, group in groups.items())
+
+
+def report(ledger):
+    runs = list(ledger.runs())
+    for run in runs:
+        run.update(title_labels(run['title']))
+
+    by_label = {}
+    for column in category_columns[1:]:
+        by_label[column] = group_by(runs, lambda run: str(run[column]))
+
+    overheads = dict((name, {'compounds': n, 'seconds': seconds})
+                     for name, (n, seconds) in
+                     ledger.overhead_totals().items())
+    return {'total': summarise(runs),
+            'by_stage': group_by(runs, lambda run: run['stage']),
+            'by_scaffold': group_by(runs, lambda run: run['scaffold']),
+            'by_substituent': by_label,
+            'overheads': overheads}
+
+
+def format_optional(value, spec):
+    return '-' if value is None else format(value, spec)
+
+
+def print_table(title, groups, total_core_hours):
+    print('\n{}'.format(title))
+    print('{:>14} {:>9} {:>11} {:>7} {:>12} {:>9} {:>11} {:>10} {:>12}'.format(
+        '', 'compounds', 'core-hours', 'share', 'per compound', 'cpu eff.',
+        'SCF cycles', 'opt steps', 'max RSS (MB)'))
+    for name, s in sorted(groups.items(), key=lambda g: -g[1]['core_hours']):
+        print('{:>14} {:>9} {:>11.1f} {:>6.1f}% {:>12.2f} {:>9} {:>11.1f} '
+              '{:>10.1f} {:>12}'.format(
+                  name[-14:], s['compounds'], s['core_hours'],
+                  100 * s['core_hours'] / max(total_core_hours, 1e-9),
+                  s['core_hours_per_compound'],
+                  format_optional(s['cpu_efficiency'], '.2f'),
+                  s['scf_cycles_per_compound'], s['opt_steps_per_compound'],
+                  format_optional(s['max_rss'], '.0f')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--ledger', default='../data/ledger.db')
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as json')
+    args = parser.parse_args()
+
+    with Ledger(args.ledger) as ledger:
+        summary = report(ledger)
+
+    if args.json:
+        print(json.dumps(summary, indent=2, sort_keys=True))
+        return
+
+    total = summary['total']
+    print('{} g09 runs for {} compounds used {:.1f} core-hours'.format(
+          total['runs'], total['compounds'], total['core_hours']))
+    print_table('by stage', summary['by_stage'], total['core_hours'])
+    print_table('by scaffold', summary['by_scaffold'], total['core_hours'])
+    for column, groups in sorted(summary['by_substituent'].items()):
+        print_table('by {}'.format(column), groups, total['core_hours'])
+
+    print('\npython side')
+    for name, o in sorted(summary['overheads'].items()):
+        if o['compounds']:
+            print('{:>14} {:>10.1f} s {:>10.3f} s per compound'.format(
+                  name, o['seconds'], o['seconds'] / o['compounds']))
+        else:
+            print('{:>14} {:>10.1f} s'.format(name, o['seconds']))
+
+
+if __name__ == '__main__':
+    main()
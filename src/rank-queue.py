@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+"""
+Prioritise the compounds still in the queue by the results so far.
+
+A surrogate of the excitation energies (see surrogate.py) is fitted to the
+results in calculated-data.json, and each pending compound in the workers'
+queue is given a priority by how close its predicted E(S1) - 2 E(T1) is to the
+target, so the most promising candidates are calculated first and the least
+promising are left until last. Rerun it whenever more results have been
+extracted (e.g. after extract-data.py --incremental) to re-rank the queue.
+
+usage: rank-queue.py [--queue ../data/queue.db] [--db ../data/structures.db]
+                     [--data ../data/calculated-data.json] [--target 0]
+                     [--explore 0] [--alpha 1] [--show 10]
+"""
+
+import os
+import json
+import argparse
+
+from store import StructureStore
+from work_queue import WorkQueue
+from results import title_labels
+from surrogate import rank
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--queue', default='../data/queue.db')
+    parser.add_argument('--db', default='../data/structures.db')
+    parser.add_argument('--data', default='../data/calculated-data.json')
+    parser.add_argument('--energies', choices=('td', 'tda'), default='td',
+                        help='the excitation energies to fit (default: td)')
+    parser.add_argument('--target', type=float, default=0.0,
+                        help='E(S1) - 2 E(T1) aimed for, in eV (default: 0)')
+    parser.add_argument('--explore', type=float, default=0.0,
+                        help='weight given to the uncertainty of the '
+                             'predictions, to favour compounds unlike those '
+                             'calculated so far (default: 0)')
+    parser.add_argument('--alpha', type=float, default=1.0,
+                        help='ridge penalty of the surrogate (default: 1)')
+    parser.add_argument('--show', type=int, default=10, metavar='N',
+                        help='list the N highest priority compounds')
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.queue):
+        parser.error('no queue at {}'.format(args.queue))
+    if not os.path.isfile(args.data):
+        parser.error('no results at {}, run extract-data.py first'.format(
+                     args.data))
+
+    with open(args.data) as f:
+        rows = list(json.load(f).get('_default', {}).values())
+    singlet = '{}_singlet'.format(args.energies)
+    triplet = '{}_triplet'.format(args.energies)
+    # aliases are copies of their representative's results
+    calculated = []
+    for row in rows:
+        if not row.get('alias_of'):
+            labels = title_labels(row['title'])
+            labels.update({singlet: row[singlet], triplet: row[triplet]})
+            calculated.append(labels)
+    if not calculated:
+        print('no results to rank the queue by yet')
+        return
+
+    with WorkQueue(args.queue) as queue:
+        pending = queue.pending()
+        with StructureStore(args.db, readonly=True) as db:
+            titles = [db.get(index)['title'] for index in pending]
+        scores, fission = rank(calculated, [title_labels(t) for t in titles],
+                               singlet=singlet, triplet=triplet,
+                               target=args.target, explore=args.explore,
+                               alpha=args.alpha)
+        queue.prioritise(zip(pending, scores.tolist()))
+
+    print('ranked {} pending compounds using {} results'.format(
+          len(pending), len(calculated)))
+    order = sorted(range(len(pending)), key=lambda i: -scores[i])
+    for i in order[:args.show]:
+        print('{:>8} {:>8.3f} {}'.format(pending[i], fission[i], titles[i]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""
+Columnar storage of the calculated data.
+
+The results are kept as a NumPy structured array (<name>.npy), which can be
+memory-mapped, alongside a json file of the categories
+(<name>.categories.json). extract-data.py --columnar saves them as
+calculated-data-columnar, next to the calculated-data.json it always writes.
+The substituent labels are stored as small integer codes into the categories,
+so that millions of rows can be filtered and aggregated without building a
+dict or python object per row, e.g.:
+
+    results = Results('../data/calculated-data-columnar')
+    mask = results.mask(scaffold='ciba', nx=4, ny=5)
+    ratio = results['tda_triplet'][mask] / results['tda_singlet'][mask]
+    mean_s1_by_x = results.group_mean('x_sub', 'tda_singlet')
+"""
+
+import os
+import re
+import json
+
+import numpy as np
+
+float_columns = ('td_singlet', 'td_triplet', 'tda_singlet', 'tda_triplet',
+                 'nicss_six_ring_above', 'nicss_six_ring_below',
+                 'nicss_five_ring_above', 'nicss_five_ring_below',
+                 'nicst_six_ring_above', 'nicst_six_ring_below',
+                 'nicst_five_ring_above', 'nicst_five_ring_below')
+category_columns = ('scaffold', 'nx', 'ny', 'x_sub', 'y_sub', 'z_sub')
+
+
+def scaffold_name(title):
+    """
+    Get the scaffold (e.g. ciba or ciba_thiol) from a structure title.
+    """
+    return title.split('_nx-')[0]
+
+
+def title_labels(title):
+    """
+    Get the scaffold and substituent labels from a structure title, as a dict
+    with the category_columns as keys and None for the positions without a
+    substituent.
+    """
+    scaffold, rest = title.split('_nx-', 1)
+    labels = re.match(r'(.*)_ny-(.*)_x-(.*)_y-(.*)_z-(.*)$', rest).groups()
+    return dict(zip(category_columns,
+                    [scaffold] + [label or None for label in labels]))
+
+
+def save_results(rows, filename):
+    """
+    Save the rows written by extract-data.py in the columnar format.
+
+    Args:
+        rows (list): The result dicts.
+        filename (str): The path to save to, without the extension.
+    """
+    rows = [dict(row) for row in rows]
+    for row in rows:
+        row.setdefault('scaffold', scaffold_name(row['title']))
+
+    categories = {}
+    for name in category_columns:
+        values = set(row[name] for row in rows)
+        # None sorts first, as the unsubstituted option
+        categories[name] = sorted(values, key=lambda v: (v is not None, v))
+
+    title_length = max([len(row['title']) for row in rows] + [1])
+    dtype = ([(name, np.float64) for name in float_columns] +
+             [(name, np.int16) for name in category_columns] +
+             [('alias_of', np.int64), ('title', 'U{}'.format(title_length))])
+    data = np.zeros(len(rows), dtype=dtype)
+    for name in float_columns:
+        data[name] = [row[name] for row in rows]
+    for name in category_columns:
+        lookup = dict((v, i) for i, v in enumerate(categories[name]))
+        data[name] = [lookup[row[name]] for row in rows]
+    # the structure indexes start at 1, so 0 means not an alias
+    data['alias_of'] = [row.get('alias_of') or 0 for row in rows]
+    data['title'] = [row['title'] for row in rows]
+
+    # write to temporary files and swap them in, so readers never see a
+    # partly written file
+    np.save(filename + '.tmp.npy', data)
+    with open(filename + '.tmp.categories.json', 'w') as f:
+        json.dump({'categories': categories}, f)
+    os.rename(filename + '.tmp.npy', filename + '.npy')
+    os.rename(filename + '.tmp.categories.json',
+              filename + '.categories.json')
+
+
+class Results(object):
+    """
+    Read only view of results saved with save_results.
+
+    Args:
+        filename (str): The path the results were saved to, without the
+            extension.
+        mmap (bool): Memory-map the data rather than reading it all in.
+    """
+
+    def __init__(self, filename, mmap=True):
+        self.data = np.load(filename + '.npy', mmap_mode='r' if mmap else None)
+        with open(filename + '.categories.json') as f:
+            self.categories = json.load(f)['categories']
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def columns(self):
+        return self.data.dtype.names
+
+    def __getitem__(self, name):
+        """
+        Get a column. Categorical columns are given as their integer codes.
+        """
+        return self.data[name]
+
+    def code(self, name, value):
+        """
+        Get the integer code of a category, or -1 if it doesn't occur.
+        """
+        try:
+            return self.categories[name].index(value)
+        except ValueError:
+            return -1
+
+    def decode(self, name, mask=None):
+        """
+        Get the values of a categorical column as an object array.
+        """
+        codes = self.data[name] if mask is None else self.data[name][mask]
+        return np.array(self.categories[name], dtype=object)[codes]
+
+    def mask(self, **conditions):
+        """
+        Get a boolean mask of the rows matching all of the conditions.
+
+        Categorical columns are matched against a value or list of values,
+        float columns against a (min, max) range where either can be None.
+        """
+        mask = np.ones(len(self.data), dtype=bool)
+        for name, value in conditions.items():
+            column = self.data[name]
+            if name in self.categories:
+                values = value if isinstance(value, (list, tuple)) else [value]
+                mask &= np.isin(column, [self.code(name, v) for v in values])
+            else:
+                low, high = value
+                if low is not None:
+                    mask &= column >= low
+                if high is not None:
+                    mask &= column <= high
+        return mask
+
+    def group_mean(self, by, column, mask=None):
+        """
+        Get the mean of a column for each category of another.
+
+        Returns:
+            (dict): The means as {category: mean}, for the categories that
+            have any rows.
+        """
+        codes = self.data[by]
+        values = self.data[column]
+        if mask is not None:
+            codes, values = codes[mask], values[mask]
+        n = len(self.categories[by])
+        counts = np.bincount(codes, minlength=n)
+        sums = np.bincount(codes, weights=values, minlength=n)
+        return dict((self.categories[by][i], sums[i] / counts[i])
+                    for i in np.flatnonzero(counts))
+
+    def to_dataframe(self, mask=None):
+        """
+        Get the results as a pandas DataFrame with categorical columns.
+        """
+        import pandas as pd
+
+        data = self.data if mask is None else self.data[mask]
+        columns = {}
+        for name in self.columns:
+            if name in self.categories:
+                # pandas doesn't allow None as a category, but uses a code of
+                # -1 for missing values
+                codes = np.asarray(data[name])
+                categories = self.categories[name]
+                if categories and categories[0] is None:
+                    codes, categories = codes - 1, categories[1:]
+                columns[name] = pd.Categorical.from_codes(codes, categories)
+            else:
+                columns[name] = np.asarray(data[name])
+        return pd.DataFrame(columns)
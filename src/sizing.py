@@ -0,0 +1,77 @@
+"""
+Estimates of the cores and memory to give the calculations of a compound.
+
+The cost of the TD-DFT and NMR calculations goes roughly as the cube of the
+number of basis functions, so a compound with the most basis functions in the
+study (reference_basis_functions) is given a whole node, and smaller ones a
+share of the cores that keeps their wall time about the same. The memory is
+the same share of the node's, but at least enough for a few multiples of the
+square of the basis functions, which the TD-DFT and CPHF steps need whatever
+the number of cores. Compounds sized this way can be packed several to a node
+(see calculate-properties.py --worker --pack).
+
+The constants are a starting point, to be tuned from performance-report.py.
+"""
+
+import re
+import math
+
+# basis functions of each element with 6-311++G(d,p) and pure d functions
+basis_functions = {'H': 7, 'C': 22, 'N': 22, 'O': 22, 'F': 22, 'S': 30,
+                   'Cl': 30, 'Br': 53}
+
+# the largest compounds in the study have about this many, and get a node
+reference_basis_functions = 1300
+min_cores = 4
+# memory needed whatever the cores, in 8 byte words per basis function squared
+words_per_basis_function_squared = 100
+
+memory_patt = re.compile(r"^\s*(\d+)\s*([KMGT]?B)?\s*$", re.I)
+memory_units = {'KB': 1. / 1024, 'MB': 1, 'GB': 1024, 'TB': 1024 ** 2}
+
+
+def parse_memory(mem):
+    """
+    Convert a %mem value, e.g. 58GB, to MB.
+    """
+    value, unit = memory_patt.match(mem).groups()
+    if unit:
+        return int(value) * memory_units[unit.upper()]
+    # without a unit g09 takes the memory in 8 byte words
+    return int(value) * 8. / 1024 ** 2
+
+
+def count_basis_functions(species):
+    """
+    Count the basis functions of a list of element symbols.
+    """
+    return sum(basis_functions[element] for element in species)
+
+
+def estimate(species, node_cores=24, node_mem_mb=58 * 1024):
+    """
+    Estimate the resources for a compound.
+
+    Args:
+        species (list): The element symbols of the compound.
+        node_cores (int): The cores of a node.
+        node_mem_mb (float): The memory of a node available to g09, in MB.
+
+    Returns:
+        (dict): The 'atoms', 'basis_functions', 'cores' and 'mem_mb'.
+    """
+    n = count_basis_functions(species)
+    cores = int(math.ceil(node_cores * (n / reference_basis_functions) ** 3))
+    cores = min(max(cores, min_cores), node_cores)
+    mem_mb = max(node_mem_mb * cores / node_cores,
+                 words_per_basis_function_squared * n ** 2 * 8 / 1024 ** 2)
+    return {'atoms': len(species), 'basis_functions': n, 'cores': cores,
+            'mem_mb': int(min(mem_mb, node_mem_mb))}
+
+
+def size_link0(size):
+    """
+    Get the link0 parameters giving a compound its estimated resources.
+    """
+    return {'%nprocshared': str(size['cores']),
+            '%mem': '{}MB'.format(size['mem_mb'])}
@@ -0,0 +1,129 @@
+"""
+Indexed storage for the generated structures.
+
+The structures used to be kept in a TinyDB json file, which has to be read and
+deserialised in full for every lookup. Here each record is kept as a row of a
+SQLite database, with the index as the primary key and a unique index on the
+title, so that a single compound can be pulled out without touching the rest.
+"""
+
+import json
+import sqlite3
+
+_schema = """
+CREATE TABLE IF NOT EXISTS structures (
+    idx INTEGER PRIMARY KEY,
+    title TEXT NOT NULL UNIQUE,
+    fingerprint TEXT,
+    record TEXT NOT NULL
+)
+"""
+
+
+class StructureStore(object):
+    """
+    SQLite backed store of structure records.
+
+    The records are the same dicts that generate-structures.py produces, i.e.
+    they contain the 'input', 'title' and 'index' keys alongside the
+    substituent labels.
+    """
+
+    def __init__(self, filename, readonly=False, timeout=60):
+        self.filename = filename
+        if readonly:
+            # read only connections don't take any write locks, which matters
+            # when thousands of array tasks open the same file
+            self.conn = sqlite3.connect('file:{}?mode=ro'.format(filename),
+                                        uri=True, timeout=timeout)
+        else:
+            self.conn = sqlite3.connect(filename, timeout=timeout)
+            self.conn.execute(_schema)
+            # stores written before fingerprints were added lack the column
+            columns = [c[1] for c in
+                       self.conn.execute('PRAGMA table_info(structures)')]
+            if 'fingerprint' not in columns:
+                self.conn.execute(
+                    'ALTER TABLE structures ADD COLUMN fingerprint TEXT')
+            self.conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM structures').fetchone()[0]
+
+    def __contains__(self, index):
+        row = self.conn.execute('SELECT 1 FROM structures WHERE idx = ?',
+                                (index,)).fetchone()
+        return row is not None
+
+    def close(self):
+        self.conn.close()
+
+    def get(self, index):
+        """
+        Get the record with the given index, or None if it doesn't exist.
+        """
+        row = self.conn.execute('SELECT record FROM structures WHERE idx = ?',
+                                (index,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_by_title(self, title):
+        """
+        Get the record with the given title, or None if it doesn't exist.
+        """
+        row = self.conn.execute('SELECT record FROM structures WHERE title = ?',
+                                (title,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def insert_multiple(self, records):
+        """
+        Insert an iterable of records in a single transaction.
+        """
+        with self.conn:
+            self.conn.executemany(
+                'INSERT INTO structures (idx, title, fingerprint, record) '
+                'VALUES (?, ?, ?, ?)',
+                ((r['index'], r['title'], r.get('fingerprint'), json.dumps(r))
+                 for r in records))
+
+    def all(self):
+        """
+        Iterate over all the records in index order.
+        """
+        cursor = self.conn.execute('SELECT record FROM structures ORDER BY idx')
+        for row in cursor:
+            yield json.loads(row[0])
+
+    def representatives(self):
+        """
+        Get the indices of the fingerprinted structures that aren't aliases of
+        another, as {fingerprint: [index]} in index order.
+        """
+        representatives = {}
+        for fingerprint, index in self.conn.execute(
+                "SELECT fingerprint, idx FROM structures "
+                "WHERE fingerprint IS NOT NULL AND "
+                "json_extract(record, '$.alias_of') IS NULL ORDER BY idx"):
+            representatives.setdefault(fingerprint, []).append(index)
+        return representatives
+
+    def aliases(self):
+        """
+        Get the number of structures that are equivalent to one with a lower
+        index, i.e. that have 'alias_of' set.
+        """
+        row = self.conn.execute(
+            "SELECT COUNT(*) FROM structures "
+            "WHERE json_extract(record, '$.alias_of') IS NOT NULL").fetchone()
+        return row[0]
+
+    def indices(self):
+        """
+        Get the set of indices that are in the store.
+        """
+        return set(r[0] for r in self.conn.execute('SELECT idx FROM structures'))
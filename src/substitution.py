@@ -0,0 +1,189 @@
+"""
+Array based substitution engine for the scaffold templates.
+
+The template molecule is held as arrays of species and coordinates. Because the
+template geometry never changes, the coordinates of each functional group
+grafted on to a given site are the same for every structure, so they are
+computed once (using pymatgen's Molecule.substitute, so the geometries are
+identical to substituting each structure individually) and then reused. A
+structure is then just the template with some species swapped to N and some H
+atoms removed, followed by the grafted groups in the order that substituting
+from the highest site_id downwards appends them.
+"""
+
+import numpy as np
+
+from pymatgen.core.structure import Molecule
+from pymatgen.io.gaussian import GaussianInput
+
+positions = ('x', 'y', 'z')
+
+
+class Scaffold(object):
+    """
+    A template molecule along with the sites that can be substituted.
+
+    Args:
+        gin (GaussianInput): The template input.
+        nx_sites (list): The nitrogen positions as (name, N site_ids,
+            H site_ids), where the final entry is [None].
+        ny_sites (list): As nx_sites, or [[None]] if the scaffold has no ny
+            positions.
+        sub_sites (dict): The x, y, z substituent positions as
+            {name: site_ids}.
+        subs (list): The substituents as (name, functional group), where the
+            final entry is [None].
+        prefix (str): The prefix used for the structure titles.
+    """
+
+    def __init__(self, gin, nx_sites, ny_sites, sub_sites, subs,
+                 prefix='ciba'):
+        self.gin = gin
+        self.nx_sites = nx_sites
+        self.ny_sites = ny_sites
+        self.sub_sites = sub_sites
+        self.subs = subs
+        self.prefix = prefix
+
+        mol = gin.molecule
+        nsites = len(mol)
+        self.species = np.array([site.specie.symbol for site in mol])
+        self.coords = np.array(mol.cart_coords)
+
+        # masks of the sites turned into N and the H atoms removed for each of
+        # the nitrogen position options
+        def n_masks(options):
+            n_mask = np.zeros((len(options), nsites), dtype=bool)
+            h_mask = np.zeros((len(options), nsites), dtype=bool)
+            for i, option in enumerate(options):
+                if option[0]:
+                    n_mask[i, option[1]] = True
+                    h_mask[i, option[2]] = True
+            return n_mask, h_mask
+        self._nx_n, self._nx_h = n_masks(nx_sites)
+        self._ny_n, self._ny_h = n_masks(ny_sites)
+
+        self._is_sub = np.array([bool(sub[0]) for sub in subs])
+        self._pos_masks = np.zeros((len(positions), nsites), dtype=bool)
+        for p, pos in enumerate(positions):
+            self._pos_masks[p, sub_sites[pos]] = True
+
+        # a substituent can't go on a site whose H has been removed to make
+        # room for a nitrogen lone pair
+        self._nx_clash = (self._nx_h[:, None, :] &
+                          self._pos_masks[None, :, :]).any(axis=2)
+        self._ny_clash = (self._ny_h[:, None, :] &
+                          self._pos_masks[None, :, :]).any(axis=2)
+
+        # the sites are substituted from the highest site_id downwards, which
+        # is the order the functional groups end up appended in
+        self._graft_order = sorted(((site, p) for p, pos in enumerate(positions)
+                                    for site in sub_sites[pos]), reverse=True)
+        self._grafts = {}
+        for site, _ in self._graft_order:
+            for s, sub in enumerate(subs):
+                if not sub[0]:
+                    continue
+                grafted = mol.copy()
+                grafted.substitute(site, sub[1])
+                added = grafted[nsites - 1:]
+                self._grafts[(site, s)] = (
+                    np.array([a.specie.symbol for a in added]),
+                    np.array([a.coords for a in added]))
+
+    def combinations(self):
+        """
+        Get the valid combinations of substitutions.
+
+        Returns:
+            An (n, 5) array of indices into (nx_sites, ny_sites, subs, subs,
+            subs), in the same order as itertools.product would give them.
+        """
+        shape = ((len(self.nx_sites), len(self.ny_sites)) +
+                 (len(self.subs),) * len(positions))
+        combos = np.indices(shape).reshape(len(shape), -1).T
+
+        clash = np.zeros(len(combos), dtype=bool)
+        for p in range(len(positions)):
+            clash |= (self._is_sub[combos[:, 2 + p]] &
+                      (self._nx_clash[combos[:, 0], p] |
+                       self._ny_clash[combos[:, 1], p]))
+        return combos[~clash]
+
+    def build(self, combos):
+        """
+        Build the structures for an array of combinations.
+
+        Returns:
+            A list of (species, coords) array tuples.
+        """
+        nitrogen = self._nx_n[combos[:, 0]] | self._ny_n[combos[:, 1]]
+        keep = ~(self._nx_h[combos[:, 0]] | self._ny_h[combos[:, 1]])
+        for p in range(len(positions)):
+            substituted = self._is_sub[combos[:, 2 + p]]
+            keep &= ~(substituted[:, None] & self._pos_masks[p][None, :])
+
+        species = np.where(nitrogen, 'N', self.species[None, :])
+
+        structures = []
+        for combo, combo_species, combo_keep in zip(combos, species, keep):
+            grafts = [self._grafts[(site, combo[2 + p])]
+                      for site, p in self._graft_order
+                      if self._is_sub[combo[2 + p]]]
+            structures.append((
+                np.concatenate([combo_species[combo_keep]] +
+                               [g[0] for g in grafts]),
+                np.concatenate([self.coords[combo_keep]] +
+                               [g[1] for g in grafts])))
+        return structures
+
+    def labels(self, combo):
+        """
+        Get the (nx, ny, x_sub, y_sub, z_sub) labels of a combination.
+        """
+        return ((self.nx_sites[combo[0]][0], self.ny_sites[combo[1]][0]) +
+                tuple(self.subs[s][0] for s in combo[2:]))
+
+    def title(self, combo):
+        return '{}_nx-{}_ny-{}_x-{}_y-{}_z-{}'.format(
+            self.prefix, *[label if label else ''
+                           for label in self.labels(combo)])
+
+    def records(self, combos, start_index, batch_size=1000, fingerprint=None):
+        """
+        Generate the structure records for an array of combinations.
+
+        Args:
+            combos (array): The combinations, as given by combinations().
+            start_index (int): The index given to the first combination.
+            batch_size (int): The number of structures to build at once.
+            fingerprint (function): If set, called with the species and
+                coordinates of each structure and stored as 'fingerprint'.
+
+        Yields:
+            The structure records, with the GaussianInput as a dict.
+        """
+        gin = self.gin
+        for start in range(0, len(combos), batch_size):
+            batch = combos[start:start + batch_size]
+            for i, (combo, (species, coords)) in enumerate(
+                    zip(batch, self.build(batch))):
+                nx, ny, x_sub, y_sub, z_sub = self.labels(combo)
+                mol = Molecule(species, coords, charge=gin.charge,
+                               spin_multiplicity=gin.spin_multiplicity)
+                ginp = GaussianInput(
+                    mol, charge=gin.charge,
+                    spin_multiplicity=gin.spin_multiplicity,
+                    title=self.title(combo), functional=gin.functional,
+                    basis_set=gin.basis_set,
+                    route_parameters=gin.route_parameters,
+                    input_parameters=gin.input_parameters,
+                    link0_parameters=gin.link0_parameters,
+                    dieze_tag=gin.dieze_tag)
+                record = {'input': ginp.as_dict(), 'nx': nx, 'ny': ny,
+                          'x_sub': x_sub, 'y_sub': y_sub, 'z_sub': z_sub,
+                          'title': ginp.title,
+                          'index': start_index + start + i}
+                if fingerprint:
+                    record['fingerprint'] = fingerprint(species, coords)
+                yield record
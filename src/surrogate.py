@@ -0,0 +1,116 @@
+"""
+Cheap surrogate of the excitation energies, for ranking the compounds still to
+be calculated.
+
+A compound is described by its scaffold and substituent labels
+(results.category_columns), one-hot encoded, and each energy is fitted as the
+sum of an effect per label by ridge regression. Fitting a few thousand results
+takes milliseconds, so the model can be refitted whenever new results are
+extracted. The posterior variance of the ridge fit gives how uncertain each
+prediction is, which is large for compounds with labels that haven't been seen
+much yet.
+
+Compounds are ranked by how close the predicted singlet fission energy,
+E(S1) - 2 E(T1), is to the target, with an optional bonus for uncertain
+predictions so that the poorly sampled parts of the space aren't left until
+last.
+"""
+
+import numpy as np
+
+from results import category_columns
+
+
+class LabelEncoder(object):
+    """
+    One-hot encoding of the category_columns of label dicts.
+    """
+
+    def __init__(self, rows):
+        self.columns = []
+        for name in category_columns:
+            for value in sorted(set(str(row[name]) for row in rows)):
+                self.columns.append((name, value))
+        self.lookup = dict((c, i) for i, c in enumerate(self.columns))
+
+    def encode(self, rows):
+        X = np.zeros((len(rows), len(self.columns) + 1))
+        # the intercept
+        X[:, -1] = 1
+        for i, row in enumerate(rows):
+            for name in category_columns:
+                j = self.lookup.get((name, str(row[name])))
+                # labels that weren't in the training data have no effect
+                if j is not None:
+                    X[i, j] = 1
+        return X
+
+
+class RidgeSurrogate(object):
+    """
+    Ridge regression of an energy on the one-hot encoded labels.
+
+    Args:
+        alpha (float): The strength of the ridge penalty.
+    """
+
+    def __init__(self, alpha=1.0):
+        self.alpha = alpha
+
+    def fit(self, rows, y):
+        """
+        Args:
+            rows (list): The label dicts of the calculated compounds.
+            y (array): The energy of each.
+        """
+        y = np.asarray(y, dtype=float)
+        self.encoder = LabelEncoder(rows)
+        X = self.encoder.encode(rows)
+        A = X.T.dot(X) + self.alpha * np.eye(X.shape[1])
+        # don't penalise the intercept
+        A[-1, -1] -= self.alpha
+        self.A_inv = np.linalg.pinv(A)
+        self.w = self.A_inv.dot(X.T.dot(y))
+        residuals = y - X.dot(self.w)
+        self.sigma = np.sqrt(np.mean(residuals ** 2)) if len(y) else 0.
+        return self
+
+    def predict(self, rows):
+        """
+        Returns:
+            (tuple): Arrays of the predicted energies and their standard
+            deviations.
+        """
+        X = self.encoder.encode(rows)
+        variance = np.einsum('ij,jk,ik->i', X, self.A_inv, X)
+        return X.dot(self.w), self.sigma * np.sqrt(1 + variance)
+
+
+def rank(calculated, pending, singlet='td_singlet', triplet='td_triplet',
+         target=0.0, explore=0.0, alpha=1.0):
+    """
+    Score the compounds still to be calculated.
+
+    Args:
+        calculated (list): The results so far, as dicts of the
+            category_columns and the energies.
+        pending (list): The label dicts of the compounds to score.
+        singlet, triplet (str): The energies to use for S1 and T1.
+        target (float): The singlet fission energy, E(S1) - 2 E(T1), aimed
+            for.
+        explore (float): The weight given to the uncertainty of the
+            prediction.
+        alpha (float): The strength of the ridge penalty.
+
+    Returns:
+        (tuple): Arrays of the score of each pending compound, where higher
+        scores should be calculated first, and its predicted singlet fission
+        energy.
+    """
+    s1 = RidgeSurrogate(alpha).fit(calculated, [r[singlet] for r in calculated])
+    t1 = RidgeSurrogate(alpha).fit(calculated, [r[triplet] for r in calculated])
+    s1_mean, s1_std = s1.predict(pending)
+    t1_mean, t1_std = t1.predict(pending)
+    fission = s1_mean - 2 * t1_mean
+    uncertainty = np.sqrt(s1_std ** 2 + 4 * t1_std ** 2)
+    return -np.abs(fission - target) + explore * uncertainty, fission
@@ -0,0 +1,194 @@
+"""
+Shared queue of the compounds to calculate, for pilot-job workers.
+
+The queue is a SQLite database with a row per compound. Workers claim a
+compound by taking a lease on it, which they renew while the calculations run.
+If a worker crashes, or its job is killed, the lease runs out and the compound
+is claimed again by another worker, which restarts the calculations from where
+they got to. Claims are made in an immediate transaction, so two workers never
+hold the same compound. Compounds are claimed in index order unless they have
+been given a priority (see rank-queue.py).
+
+SQLite relies on the file locking of the filesystem, which is fine on local and
+Lustre/GPFS filesystems, but may not be on some NFS mounts.
+"""
+
+import time
+import sqlite3
+
+_schema = """
+CREATE TABLE IF NOT EXISTS queue (
+    idx INTEGER PRIMARY KEY,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    priority REAL
+)
+"""
+
+states = ('pending', 'claimed', 'done', 'error')
+
+
+class WorkQueue(object):
+    """
+    SQLite backed queue of compound indexes.
+
+    Args:
+        filename (str): Path to the queue database.
+        max_attempts (int): The number of times a compound is claimed before it
+            is given up on, e.g. if it keeps crashing the workers.
+        timeout (float): Seconds to wait for another worker's lock.
+    """
+
+    def __init__(self, filename, max_attempts=3, timeout=60):
+        self.filename = filename
+        self.max_attempts = max_attempts
+        # autocommit mode, so the transactions can be started explicitly
+        self.conn = sqlite3.connect(filename, timeout=timeout,
+                                    isolation_level=None)
+        self.conn.execute(_schema)
+        # queues made before compounds were prioritised lack the column
+        columns = [c[1] for c in self.conn.execute('PRAGMA table_info(queue)')]
+        if 'priority' not in columns:
+            self.conn.execute('ALTER TABLE queue ADD COLUMN priority REAL')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS queue_state '
+                          'ON queue (state, lease_expires)')
+        # in claiming order, so the next pending compound is found without
+        # sorting the queue
+        self.conn.execute('CREATE INDEX IF NOT EXISTS queue_pending '
+                          'ON queue (state, priority DESC, idx)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    def add(self, indices):
+        """
+        Queue compounds, ignoring any that are already in the queue.
+        """
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.conn.executemany('INSERT OR IGNORE INTO queue (idx) VALUES (?)',
+                                  ((index,) for index in indices))
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
+    def claim(self, worker, lease):
+        """
+        Claim the next pending compound, or one whose lease has run out,
+        taking those with the highest priority first, then those without a
+        priority, in index order.
+
+        Args:
+            worker (str): Name of the claiming worker.
+            lease (float): Seconds until the claim runs out, unless renewed.
+
+        Returns:
+            (int): The index of the compound, or None if there is nothing left
+            to claim.
+        """
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            # give up on compounds whose workers keep dying
+            self.conn.execute(
+                "UPDATE queue SET state = 'error', worker = NULL "
+                "WHERE state = 'claimed' AND lease_expires < ? "
+                "AND attempts >= ?", (now, self.max_attempts))
+            # the pending compounds and those whose lease has run out are
+            # looked up separately, so each can use an index rather than the
+            # whole queue being sorted. NULLs sort last with DESC, so
+            # compounds without a priority follow those with one.
+            pending = self.conn.execute(
+                "SELECT idx, priority FROM queue WHERE state = 'pending' "
+                "ORDER BY priority DESC, idx LIMIT 1").fetchone()
+            expired = self.conn.execute(
+                "SELECT idx, priority FROM queue WHERE state = 'claimed' "
+                "AND lease_expires < ? ORDER BY priority DESC, idx LIMIT 1",
+                (now,)).fetchone()
+            rows = [r for r in (pending, expired) if r]
+            row = min(rows, key=lambda r: (r[1] is None, -(r[1] or 0), r[0])) \
+                if rows else None
+            if row:
+                self.conn.execute(
+                    "UPDATE queue SET state = 'claimed', worker = ?, "
+                    "lease_expires = ?, attempts = attempts + 1 "
+                    "WHERE idx = ?", (worker, now + lease, row[0]))
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+        return row[0] if row else None
+
+    def renew(self, index, worker, lease):
+        """
+        Extend a claim.
+
+        Returns:
+            (bool): False if the worker no longer holds the claim, e.g. as it
+            ran out and was taken by another worker.
+        """
+        cursor = self.conn.execute(
+            "UPDATE queue SET lease_expires = ? WHERE idx = ? AND worker = ? "
+            "AND state = 'claimed'", (time.time() + lease, index, worker))
+        return cursor.rowcount == 1
+
+    def finish(self, index, worker, state='done'):
+        """
+        Mark a claimed compound as done or error.
+        """
+        self.conn.execute(
+            "UPDATE queue SET state = ?, worker = NULL, lease_expires = NULL "
+            "WHERE idx = ? AND worker = ?", (state, index, worker))
+
+    def release(self, index, worker):
+        """
+        Give up a claim without it counting as an attempt, e.g. when a worker
+        runs out of time.
+        """
+        self.conn.execute(
+            "UPDATE queue SET state = 'pending', worker = NULL, "
+            "lease_expires = NULL, attempts = MAX(attempts - 1, 0) "
+            "WHERE idx = ? AND worker = ? AND state = 'claimed'",
+            (index, worker))
+
+    def pending(self):
+        """
+        Get the indexes of the compounds that haven't been claimed yet.
+        """
+        return [row[0] for row in self.conn.execute(
+            "SELECT idx FROM queue WHERE state = 'pending' ORDER BY idx")]
+
+    def prioritise(self, priorities):
+        """
+        Set the priority of pending compounds, from an iterable of
+        (index, priority), where compounds with a higher priority are claimed
+        first.
+        """
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.conn.executemany(
+                "UPDATE queue SET priority = ? WHERE idx = ? AND "
+                "state = 'pending'",
+                ((priority, index) for index, priority in priorities))
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
+    def counts(self):
+        """
+        Get the number of compounds in each state.
+        """
+        counts = dict((state, 0) for state in states)
+        counts.update(self.conn.execute(
+            'SELECT state, COUNT(*) FROM queue GROUP BY state'))
+        return counts
@@ -0,0 +1,27 @@
+import os
+import sys
+import importlib.util
+
+import pytest
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+src = os.path.join(repo, 'src')
+stub = os.path.join(repo, 'benchmarks', 'stub')
+templates = os.path.join(repo, 'templates')
+sys.path.insert(0, src)
+
+
+def load_script(name):
+    """
+    Import one of the hyphenated scripts in src/ as a module.
+    """
+    spec = importlib.util.spec_from_file_location(
+        name.replace('-', '_'), os.path.join(src, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def calculate_properties():
+    return load_script('calculate-properties')
@@ -0,0 +1,35 @@
+import os
+
+import archives
+
+
+def test_archiver_copies_back_on_failure(tmp_path, monkeypatch):
+    run_directory = tmp_path / 'scratch' / 'compound'
+    run_directory.mkdir(parents=True)
+    (run_directory / 'relax.log').write_text('log\n')
+    calculations = tmp_path / 'calculations'
+    calculations.mkdir()
+
+    def write_archive(filename, directory, level=None):
+        raise IOError('No space left on device')
+
+    monkeypatch.setattr(archives, 'write_archive', write_archive)
+    archiver = archives.Archiver()
+    archiver.start()
+    archiver.add(str(run_directory), str(calculations / 'compound.tar.gz'), 7)
+    archiver.close()
+
+    [(key, seconds, error)] = archiver.finished()
+    assert key == 7
+    assert 'No space left on device' in error
+    assert not run_directory.exists()
+    assert (calculations / 'compound' / 'relax.log').read_text() == 'log\n'
+    assert not os.path.exists(str(calculations / 'compound.tar.gz'))
+
+
+def test_is_within_directory():
+    assert archives.is_within_directory('../data', '../data/calculations')
+    assert archives.is_within_directory('.', 'compound/relax.log')
+    assert not archives.is_within_directory('../data', '../data-evil')
+    assert not archives.is_within_directory('.', '../compound/relax.log')
+    assert not archives.is_within_directory('compound', 'compound/../x')
@@ -0,0 +1,88 @@
+import os
+import subprocess
+
+import numpy as np
+from pymatgen.io.gaussian import GaussianInput, GaussianOutput
+
+from conftest import stub, templates
+
+
+def run_stub(name, **env):
+    env = dict(os.environ, STUB_G09_SLEEP='0', **env)
+    with open(name + '.com') as fin, open(name + '.log', 'w') as fout:
+        subprocess.call([os.path.join(stub, 'g09')], stdin=fin,
+                        stdout=fout, env=env)
+
+
+def test_restart_relax_from_last_geometry(calculate_properties, tmp_path,
+                                          monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    rin = GaussianInput.from_file(os.path.join(templates,
+                                               'input-template.com'))
+    rin.write_file('relax.com', cart_coords=True)
+    # the optimisation runs out of steps, moving the atoms at each one
+    run_stub('relax', STUB_G09_DOOM='oscillate')
+    rout = GaussianOutput('relax.log')
+    assert not rout.properly_terminated
+    first = np.array(rout.structures[0].cart_coords)
+    last = np.array(rout.final_structure.cart_coords)
+    assert np.abs(last - first).max() > 1e-3
+
+    runs = []
+    monkeypatch.setattr(calculate_properties, 'run_gaussian',
+                        lambda name, entry=None: runs.append(name))
+    calculate_properties.restart_relax(rout)
+
+    assert runs == ['relax']
+    restarted = GaussianInput.from_file('relax.com')
+    assert np.allclose(restarted.molecule.cart_coords, last, atol=1e-5)
+    with open('relax.com') as f:
+        assert 'integral=(acc2e=12)' in f.read()
+
+
+def test_lease_survives_locked_database(calculate_properties, tmp_path,
+                                        monkeypatch):
+    work_queue = calculate_properties.WorkQueue
+    queue_file = str(tmp_path / 'queue.db')
+    with work_queue(queue_file) as queue:
+        queue.add([0])
+        index = queue.claim('worker', 60)
+
+    renewals = []
+
+    def renew(self, *args):
+        renewals.append(args)
+        if len(renewals) == 1:
+            raise calculate_properties.sqlite3.OperationalError(
+                'database is locked')
+        return True
+
+    monkeypatch.setattr(work_queue, 'renew', renew)
+    lease = calculate_properties.Lease(queue_file, index, 'worker', 0.03)
+    lease.start()
+    while len(renewals) < 3 and lease.is_alive():
+        lease.join(0.01)
+    assert lease.is_alive()
+    lease.stop()
+
+
+def test_split_log_keeps_error_footer(calculate_properties, tmp_path,
+                                      monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open('chain.log', 'w') as f:
+        f.write(' TD-DFT output\n'
+                ' Normal termination of Gaussian 09 at Mon Jan  1.\n'
+                ' TDA output\n'
+                ' Error termination request processed by link 9999.\n'
+                ' Error termination via Lnk1e in /g09/l9999.exe at Mon Jan  1.\n'
+                ' Job cpu time:       0 days  0 hours  1 minutes  2.0 seconds.\n')
+
+    ran = calculate_properties.split_log('chain.log', ['td', 'tda', 'nics'])
+
+    assert ran == ['td', 'tda']
+    with open('tda.log') as f:
+        tda = f.read()
+    assert tda.startswith(' TDA output\n')
+    assert 'Error termination via Lnk1e' in tda
+    assert tda.endswith('seconds.\n')
+    assert not os.path.exists('nics.log')
@@ -0,0 +1,11 @@
+from work_queue import WorkQueue
+
+
+def test_claim_order(tmp_path):
+    with WorkQueue(str(tmp_path / 'queue.db')) as queue:
+        queue.add(range(6))
+        queue.prioritise([(3, 2.0), (4, 1.0)])
+        # a lease that has already run out
+        assert queue.claim('a', -1) == 3
+        claimed = [queue.claim('b', 60) for _ in range(7)]
+    assert claimed == [3, 4, 0, 1, 2, 5, None]